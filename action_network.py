@@ -1,56 +1,216 @@
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 import os
 import urllib.parse
 import re
+import time
+from resources import RESOURCE_CLASSES
+from hal_parser import loads, iter_embedded
+from throttling import AdaptiveConcurrency, ActionNetworkError, backoff_delay, parse_retry_after
 
-class ActionNetwork():
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+
+class ActionNetworkBase():
     UUID_REGEX = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
 
-    def __init__(self, key=None):
-        self.base_url = "https://actionnetwork.org/api/v2/"
+    def _get_resource_slug(self, resource):
+        if "/" in resource:
+            slug = resource.split('/')[-1]
+        else:
+            slug = resource
+        prefix = "osdi" if self._is_osdi(slug) else "action_network"
+        return f"{prefix}:{slug}"
+
+    def _is_osdi(self, resource_slug):
+        return not resource_slug in ['custom_fields', 'campaigns', 'event_campaigns']
+
+    def _item_maker(self, resource, kwargs):
+        # Pops the compact options from kwargs so the rest go to the request.
+        # fields projects the kept fields, keep_raw also keeps the HAL dict
+        slug = self._get_resource_slug(resource)
+        fields = kwargs.pop("fields", None)
+        keep_raw = kwargs.pop("keep_raw", False)
+        compact = kwargs.pop("compact", False) or fields is not None
+        if compact and slug in RESOURCE_CLASSES:
+            resource_class = RESOURCE_CLASSES[slug]
+            return lambda item: resource_class.from_json(item, fields, keep_raw)
+        return self._extract_ids
+
+    def _check_page(self, res, url):
+        # A listing that stops part way would look like a short collection
+        if res.status_code != 200:
+            raise ActionNetworkError(
+                f"GET {url} returned status {res.status_code}", res)
+        return res
+
+    def _extract_ids(self, resource):
+        for key in resource["_links"]:
+            prefix = key.split(":")[-1]
+            if prefix in ["person", "tag", "event_campaign", "event", "petition", "form"] or key == "self":
+                uuids = self.UUID_REGEX.findall(resource["_links"][key]["href"])
+                id_key = f"{prefix}_id" if key != "self" else "id"
+                resource[id_key] = uuids[-1]
+        return resource
+
+
+class ActionNetwork(ActionNetworkBase):
+    def __init__(self, key=None, pool_connections=1, pool_maxsize=10, timeout=30, rate_limiter=None,
+                 circuit_breaker=None, max_retries=5, concurrency=None, base_url=None, stream_pages=False):
+        self.base_url = base_url if base_url else "https://actionnetwork.org/api/v2/"
         self.api_key = key if key else os.environ.get("ACTION_NETWORK_API")
         if not self.api_key:
-            raise "API Key not provided"
-    
-    def get(self, resource, id):
+            raise ValueError("API Key not provided")
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.circuit_breaker = circuit_breaker
+        self.max_retries = max_retries
+        # Read listed items out of each page one at a time, rather than
+        # decoding the whole page first
+        self.stream_pages = stream_pages
+        # Called as hook(method, url, response, elapsed, attempt) after every attempt
+        self.request_hooks = []
+        self.concurrency = concurrency if concurrency else AdaptiveConcurrency(
+            maximum=pool_maxsize)
+        self.session = self._make_session(pool_connections, pool_maxsize)
+
+    def _make_session(self, pool_connections, pool_maxsize):
+        session = requests.Session()
+        # One pool per host, sized to the number of threads sharing this client
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({
+            "OSDI-API-Token": self.api_key,
+            "Content-Type": "Application/JSON",
+            "Connection": "keep-alive"
+        })
+        return session
+
+    def close(self):
+        self.session.close()
+
+    def get(self, resource, id, **kwargs):
+        make_item = self._item_maker(resource, kwargs)
         resource_url = urllib.parse.urljoin(self.base_url, resource)
         url = f"{resource_url}/{id}"
-        return self._extract_ids(self._get(url).json())
+        res = self._get(url)
+        if res.status_code == 404:
+            return None
+        return make_item(loads(self._check_page(res, url).content))
 
     def get_page(self, resource, page=1, **kwargs):
+        res = self._get_page_response(resource, page, **kwargs)
+        return list(self._page_items(res, self._get_resource_slug(resource), {}))
+
+    def _get_page_json(self, resource, page=1, **kwargs):
+        res = self._get_page_response(resource, page, **kwargs)
+        return loads(res.content)
+
+    def _get_page_response(self, resource, page=1, **kwargs):
         url = urllib.parse.urljoin(self.base_url, resource)
-        params = kwargs['params'] if kwargs.get('params') else {}
+        # Copy so concurrent page fetches don't share one params dict
+        params = dict(kwargs['params']) if kwargs.get('params') else {}
         params['page'] = page
         kwargs['params'] = params
-        res = self._get(url, **kwargs)
-        if res.status_code == 200:
-            return res.json()["_embedded"][self._get_resource_slug(resource)]
-    
-    def get_all(self, resource, **kwargs):
-        result_page = [None]
-        results = []
+        return self._check_page(self._get(url, **kwargs), url)
+
+    def _page_items(self, res, slug, page):
+        # Yields the page's items, filling page with its other top level
+        # fields (_links, total_pages...) by the time they run out
+        if self.stream_pages:
+            return iter_embedded(res.content, slug, page)
+        page.update(loads(res.content))
+        return iter(page.pop("_embedded")[slug])
+
+    def get_all(self, resource, max_workers=None, **kwargs):
+        if max_workers:
+            return list(self.iter_all_parallel(resource, max_workers, **kwargs))
+        return list(self.iter_all(resource, **kwargs))
+
+    def iter_all(self, resource, **kwargs):
+        make_item = self._item_maker(resource, kwargs)
         url = urllib.parse.urljoin(self.base_url, resource)
         slug = self._get_resource_slug(resource)
-        while len(result_page) > 0:
-            res = self._get(url, **kwargs)
-            if res.status_code != 200:
-                # TODO: Throw error
-                break
-            page = res.json()
-            result_page = page["_embedded"][slug]
-            if not page["_links"].get("next"):
-                break
-            url = page["_links"]["next"]["href"]
-            results.extend(result_page)
-        
-        return [self._extract_ids(result) for result in results]
-    
+        while url:
+            res = self._check_page(self._get(url, **kwargs), url)
+            page = {}
+            for result in self._page_items(res, slug, page):
+                yield make_item(result)
+            next_link = page["_links"].get("next")
+            url = next_link["href"] if next_link else None
+            # The next link already carries the query string
+            kwargs.pop('params', None)
+
+    def iter_all_parallel(self, resource, max_workers=4, **kwargs):
+        make_item = self._item_maker(resource, kwargs)
+        slug = self._get_resource_slug(resource)
+        res = self._get_page_response(resource, 1, **kwargs)
+        first_page = {}
+        for result in self._page_items(res, slug, first_page):
+            yield make_item(result)
+        total_pages = first_page.get("total_pages") or 1
+        if total_pages < 2:
+            return
+
+        def fetch(page):
+            # Items are made in the worker, so raw pages don't pile up
+            res = self._get_page_response(resource, page, **kwargs)
+            return [make_item(result) for result in self._page_items(res, slug, {})]
+
+        # Run each fetch in a copy of the caller's context
+        context = contextvars.copy_context()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # map yields in submission order, so pages come back in order
+            pages = executor.map(
+                lambda page: context.copy().run(fetch, page),
+                range(2, total_pages + 1)
+            )
+            for results in pages:
+                yield from results
+
     def _request(self, method, url, **kwargs):
-        headers = kwargs['headers'] if kwargs.get('headers') else {}
-        headers["OSDI-API-Token"] = self.api_key
-        headers["Content-Type"] = "Application/JSON"
-        kwargs['headers'] = headers
-        return requests.request(method, url, **kwargs)
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.max_retries + 1):
+            res, error = self._send(method, url, attempt, **kwargs)
+            if error is None and res.status_code not in RETRY_STATUSES:
+                if self.circuit_breaker:
+                    self.circuit_breaker.record_success()
+                return res
+            if self.circuit_breaker:
+                self.circuit_breaker.record_failure()
+            if attempt < self.max_retries:
+                retry_after = parse_retry_after(
+                    res.headers.get("Retry-After")) if res is not None else None
+                time.sleep(backoff_delay(attempt, retry_after))
+        if error is not None:
+            raise ActionNetworkError(f"{method} {url} failed: {error}") from error
+        raise ActionNetworkError(
+            f"{method} {url} failed with status {res.status_code}", res)
+
+    def _send(self, method, url, attempt, **kwargs):
+        if self.circuit_breaker:
+            self.circuit_breaker.wait()
+        if self.rate_limiter:
+            self.rate_limiter.acquire()
+        self.concurrency.acquire()
+        start = time.monotonic()
+        res, error = None, None
+        try:
+            res = self.session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+        finally:
+            # Any other exception still gives the slot back, counted as a failure
+            elapsed = time.monotonic() - start
+            ok = res is not None and res.status_code not in RETRY_STATUSES
+            self.concurrency.release(elapsed, ok)
+        for hook in self.request_hooks:
+            hook(method, url, res, elapsed, attempt)
+        return res, error
 
     def _get(self, url, **kwargs):
         return self._request("GET", url, **kwargs)
@@ -69,26 +229,6 @@ class ActionNetwork():
     def delete(self, relative_url, **kwargs):
         url = urllib.parse.urljoin(self.base_url, relative_url)
         return self._delete(url, **kwargs)
-    
-    def _get_resource_slug(self, resource):
-        if "/" in resource:
-            slug = resource.split('/')[-1]
-        else:
-            slug = resource
-        prefix = "osdi" if self._is_osdi(slug) else "action_network"
-        return f"{prefix}:{slug}"
-    
-    def _is_osdi(self, resource_slug):
-        return not resource_slug in ['custom_fields', 'campaigns', 'event_campaigns']
-    
-    def _extract_ids(self, resource):
-        for key in resource["_links"]:
-            prefix = key.split(":")[-1]
-            if prefix in ["person", "tag", "event_campaign", "event", "petition", "form"] or key == "self":
-                uuids = self.UUID_REGEX.findall(resource["_links"][key]["href"])
-                id_key = f"{prefix}_id" if key != "self" else "id"
-                resource[id_key] = uuids[-1]
-        return resource
 
 if __name__ == "__main__":
     pass
\ No newline at end of file
@@ -0,0 +1,178 @@
+import aiohttp
+import asyncio
+import os
+import urllib.parse
+from action_network import ActionNetworkBase, ActionNetworkError, RETRY_STATUSES
+from throttling import AdaptiveConcurrency, RateLimitTimeout, backoff_delay, parse_retry_after
+from hal_parser import loads
+
+
+class AsyncResponse():
+    def __init__(self, status_code, content, headers):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+
+    def json(self):
+        return loads(self.content)
+
+
+class AsyncActionNetwork(ActionNetworkBase):
+    def __init__(self, key=None, pool_size=10, timeout=30, rate_limiter=None, circuit_breaker=None, max_retries=5,
+                 concurrency=None, base_url=None):
+        self.base_url = base_url if base_url else "https://actionnetwork.org/api/v2/"
+        self.api_key = key if key else os.environ.get("ACTION_NETWORK_API")
+        if not self.api_key:
+            raise ValueError("API Key not provided")
+        self.pool_size = pool_size
+        # Pass the synchronous client's limiter to share its limit
+        self.concurrency = concurrency if concurrency else AdaptiveConcurrency(
+            maximum=pool_size)
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.circuit_breaker = circuit_breaker
+        self.max_retries = max_retries
+        # Called as hook(method, url, response, elapsed, attempt) after every attempt
+        self.request_hooks = []
+        self.session = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def open(self):
+        # The session must be created inside the running loop
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                headers={
+                    "OSDI-API-Token": self.api_key,
+                    "Content-Type": "Application/JSON"
+                },
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def get(self, resource, id, **kwargs):
+        make_item = self._item_maker(resource, kwargs)
+        resource_url = urllib.parse.urljoin(self.base_url, resource)
+        url = f"{resource_url}/{id}"
+        res = await self._get(url)
+        if res.status_code == 404:
+            return None
+        return make_item(self._check_page(res, url).json())
+
+    async def get_many(self, resource, ids, **kwargs):
+        return await asyncio.gather(*[self.get(resource, id, **kwargs) for id in ids])
+
+    async def get_page(self, resource, page=1, **kwargs):
+        page_json = await self._get_page_json(resource, page, **kwargs)
+        return page_json["_embedded"][self._get_resource_slug(resource)]
+
+    async def _get_page_json(self, resource, page=1, **kwargs):
+        url = urllib.parse.urljoin(self.base_url, resource)
+        params = dict(kwargs['params']) if kwargs.get('params') else {}
+        params['page'] = page
+        kwargs['params'] = params
+        res = await self._get(url, **kwargs)
+        return self._check_page(res, url).json()
+
+    async def get_all(self, resource, **kwargs):
+        make_item = self._item_maker(resource, kwargs)
+        first_page = await self._get_page_json(resource, 1, **kwargs)
+        slug = self._get_resource_slug(resource)
+        results = list(first_page["_embedded"][slug])
+        total_pages = first_page.get("total_pages") or 1
+        pages = await asyncio.gather(*[
+            self.get_page(resource, page=page, **kwargs)
+            for page in range(2, total_pages + 1)
+        ])
+        for page in pages:
+            results.extend(page)
+        return [make_item(result) for result in results]
+
+    async def _request(self, method, url, **kwargs):
+        await self.open()
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries + 1):
+            res, error = await self._send(method, url, attempt, **kwargs)
+            if error is None and res.status_code not in RETRY_STATUSES:
+                if self.circuit_breaker:
+                    await loop.run_in_executor(None, self.circuit_breaker.record_success)
+                return res
+            if self.circuit_breaker:
+                await loop.run_in_executor(None, self.circuit_breaker.record_failure)
+            if attempt < self.max_retries:
+                retry_after = parse_retry_after(
+                    res.headers.get("Retry-After")) if res is not None else None
+                await asyncio.sleep(backoff_delay(attempt, retry_after))
+        if error is not None:
+            raise ActionNetworkError(f"{method} {url} failed: {error}") from error
+        raise ActionNetworkError(
+            f"{method} {url} failed with status {res.status_code}", res)
+
+    async def _send(self, method, url, attempt, **kwargs):
+        loop = asyncio.get_running_loop()
+        if self.circuit_breaker:
+            await loop.run_in_executor(None, self.circuit_breaker.wait)
+        if self.rate_limiter:
+            await self._wait_for_rate_limit()
+        await self.concurrency.acquire_async()
+        start = loop.time()
+        res, error = None, None
+        try:
+            async with self.session.request(method, url, **kwargs) as raw:
+                content = await raw.read()
+                res = AsyncResponse(raw.status, content, raw.headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = e
+        finally:
+            elapsed = loop.time() - start
+            ok = res is not None and res.status_code not in RETRY_STATUSES
+            self.concurrency.release(elapsed, ok)
+        for hook in self.request_hooks:
+            hook(method, url, res, elapsed, attempt)
+        return res, error
+
+    async def _wait_for_rate_limit(self):
+        # Bounded by the limiter's max_wait, as TokenBucket.acquire is
+        loop = asyncio.get_running_loop()
+        waited = 0
+        while True:
+            wait = await loop.run_in_executor(None, self.rate_limiter.reserve)
+            if wait <= 0:
+                return waited
+            if waited + wait > self.rate_limiter.max_wait:
+                raise RateLimitTimeout(
+                    f"Waited {waited:.1f}s for an Action Network rate limit slot")
+            await asyncio.sleep(wait)
+            waited += wait
+
+    async def _get(self, url, **kwargs):
+        return await self._request("GET", url, **kwargs)
+
+    async def _delete(self, url, **kwargs):
+        return await self._request("DELETE", url, **kwargs)
+
+    async def post(self, relative_url, **kwargs):
+        url = urllib.parse.urljoin(self.base_url, relative_url)
+        return await self._request("POST", url, **kwargs)
+
+    async def put(self, relative_url, **kwargs):
+        url = urllib.parse.urljoin(self.base_url, relative_url)
+        return await self._request("PUT", url, **kwargs)
+
+    async def delete(self, relative_url, **kwargs):
+        url = urllib.parse.urljoin(self.base_url, relative_url)
+        return await self._delete(url, **kwargs)
+
+
+if __name__ == "__main__":
+    pass
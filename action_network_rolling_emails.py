@@ -1,15 +1,34 @@
-from action_network import ActionNetwork
+# Loaded before the imports below, which read their settings at import
 from dotenv import load_dotenv
-import os
-import pyairtable as airtable
-from datetime import datetime
-
 load_dotenv()
 
+from action_network import ActionNetworkError
+from action_network_async import AsyncActionNetwork
+from clients import get_action_network, get_airtable
+from airtable_messages import load_messages
+from target_allocator import TargetAllocator, SharedTargetAllocator
+from pipeline import Pipeline
+from person_cache import get_person_cache
+from resources import Person
+from redis_client import get_redis
+from metrics import current_emailer, phase_timer, record_person_cache
+import asyncio
+import threading
+import urllib.parse
+import os
+from datetime import datetime, timedelta, timezone
+
 
 class RollingEmailer():
-    def __init__(self, trigger_tag_id, target_view, message_view, prefix, end_tag_id, an_key="ACTION_NETWORK_API", airtable_key="AIRTABLE_API_KEY", targets_each=1, delay_mins=0):
-        self.an = ActionNetwork(key=os.environ.get(an_key))
+    # The only fields read from listed taggings and fetched people
+    TAGGING_FIELDS = ("modified_date",)
+    PERSON_FIELDS = ("custom_fields",)
+
+    def __init__(self, trigger_tag_id, target_view, message_view, prefix, end_tag_id, an_key="ACTION_NETWORK_API", airtable_key="AIRTABLE_API_KEY", targets_each=1, delay_mins=0, rate_limit=None, watermark=None, pending_tagging_ids=None):
+        current_emailer.set(prefix)
+        self.an_key = os.environ.get(an_key)
+        # Shared per credential, so pools and limiter state outlive this run
+        self.an = get_action_network(self.an_key, rate_limit)
         self.trigger_tag_id = trigger_tag_id
         self.airtable_base = os.environ.get("AIRTABLE_BASE")
         self.airtable_target_table = os.environ.get("AIRTABLE_TARGET_TABLE")
@@ -18,60 +37,307 @@ class RollingEmailer():
         self.airtable_message_view = message_view
         self.prefix = prefix
         self.end_tag_id = end_tag_id
-        self.airtable = airtable.Api(os.environ.get(airtable_key))
+        self.airtable = get_airtable(os.environ.get(airtable_key))
         self.targets_each = targets_each
         self.delay_mins = delay_mins
+        self.page_workers = int(os.environ.get("ACTION_NETWORK_PAGE_WORKERS", 4))
+        self.people_concurrency = int(
+            os.environ.get("ACTION_NETWORK_PEOPLE_CONCURRENCY", 10))
+        self.airtable_flush_every = int(os.environ.get("AIRTABLE_FLUSH_EVERY", 10))
+        self.people_batch_size = int(os.environ.get("PEOPLE_BATCH_SIZE", 25))
+        self.pipeline_workers = int(os.environ.get("PIPELINE_WORKERS", 4))
+        self.pipeline_queue_size = int(os.environ.get("PIPELINE_QUEUE_SIZE", 10))
+        self.target_allocator = None
+        self.message_cache_ttl = int(
+            os.environ.get("AIRTABLE_MESSAGE_CACHE_TTL", 300))
+        self.messages = None
+        self.person_cache = get_person_cache(self.an_key, get_redis(), fields=self.PERSON_FIELDS)
+        # Local copy of taggings, target indexes and assignments, if any,
+        # and the prefixes whose target indexes people are looked up with
+        self.mirror = None
+        self.mirror_prefixes = [prefix]
+        # Latest tagging modified_date seen, and taggings still waiting on delay_mins
+        self.watermark = watermark
+        self.pending_tagging_ids = list(pending_tagging_ids or [])
+        # One event loop and async client for the whole run, made on first use
+        self.loop = None
+        self.async_an = None
+        self.async_lock = threading.Lock()
+
+    def close(self):
+        with self.async_lock:
+            if self.loop is None:
+                return
+            if self.async_an is not None:
+                self.loop.run_until_complete(self.async_an.close())
+            self.loop.close()
+            self.loop = None
+            self.async_an = None
+
+    def run_async(self, coroutine):
+        # The loop isn't running between calls, so any one thread may use it
+        with self.async_lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+            return self.loop.run_until_complete(coroutine)
 
     def log(self, text):
         print(f"{self.prefix}: {text}")
 
     def process(self):
+        self.messages = self._load_messages()
+        self.target_allocator = self._load_target_allocator()
         taggings = self.new_taggings()
-        processed_taggings = []
         self.log(f"Processing {len(taggings)} new taggings.")
-        people = self.new_people(taggings)
-        for i in range(len(people)):
-            tagging = taggings[i]
-            target_index = self._get_target_index(people[i])
-            difference = datetime.now() - \
-                datetime.strptime(
-                    tagging['modified_date'], '%Y-%m-%dT%H:%M:%SZ')
-            if target_index == 0 or (difference.total_seconds() / 60) > self.delay_mins:
-                self.assign_target(people[i])
-                self.an._delete(tagging["_links"]["self"]["href"])
-                processed_taggings.append(tagging)
+        try:
+            result = self.process_chunk(taggings)
+        finally:
+            self.close()
+            # Emails already assigned must be counted even if the run fails
+            self.flush_target_updates()
         # self.delete_taggings(taggings)
+        self.pending_tagging_ids = result["deferred"]
+        self.advance_watermark(taggings)
         self.log(
-            f"Processing complete for {len(processed_taggings)} taggings.")
-        return len(people)
+            f"Processing complete for {result['processed']} taggings.")
+        return len(taggings)
+
+    def process_chunk(self, taggings, done=None, on_error=None):
+        return self.process_jobs(self._fetch_jobs(taggings, on_error), done=done, on_error=on_error)
+
+    def process_jobs(self, jobs, done=None, on_error=None, delete_taggings=True):
+        # done holds tagging ids whose person was already emailed, so a retried
+        # chunk only finishes the cleanup for them. Without delete_taggings
+        # the taggings are left for the other emailers sharing them
+        done = done if done is not None else set()
+        result = {"processed": 0, "deferred": []}
+        committed = [0]
+        lock = threading.Lock()
+
+        def assign(job):
+            # Single worker: target allocation has to happen in order
+            if job["tagging"]["id"] in done:
+                return job
+            if not self._is_due(job["tagging"], job["person"]):
+                result["deferred"].append(job["tagging"]["id"])
+                return None
+            job["assignment"] = self.compute_assignment(job["person"])
+            job["assignment"]["tagging_id"] = job["tagging"]["id"]
+            return job
+
+        def write_action_network(job):
+            if "assignment" in job:
+                self.write_assignment(job["assignment"])
+                done.add(job["tagging"]["id"])
+            return job
+
+        def write_airtable(job):
+            if "assignment" in job:
+                self.record_assignment(job["assignment"])
+                committed[0] += 1
+                if committed[0] % self.airtable_flush_every == 0:
+                    self.flush_target_updates()
+            return job
+
+        def clean_up(job):
+            if delete_taggings:
+                self.delete_taggings([job["tagging"]])
+            elif "assignment" not in job:
+                return
+            with lock:
+                result["processed"] += 1
+
+        Pipeline([
+            (self._timed("assignment", assign), 1),
+            (self._timed("action_network_writes", write_action_network), self.pipeline_workers),
+            (self._timed("airtable_writes", write_airtable), 1),
+            (self._timed("cleanup", clean_up), self.pipeline_workers)
+        ], queue_size=self.pipeline_queue_size).run(
+            jobs,
+            on_error=(lambda job, e: on_error(job["tagging"], e)) if on_error else None
+        )
+        return result
+
+    def _timed(self, phase, function):
+        def timed(job):
+            with phase_timer(phase):
+                return function(job)
+        return timed
+
+    def _fetch_jobs(self, taggings, on_error=None):
+        # People are fetched a batch at a time so writes start before the
+        # last person arrives
+        for i in range(0, len(taggings), self.people_batch_size):
+            batch = taggings[i:i + self.people_batch_size]
+            try:
+                people = self.new_people(batch)
+            except Exception as e:
+                if on_error is None:
+                    raise
+                # Only this batch's taggings fail; the rest carry on
+                for tagging in batch:
+                    on_error(tagging, e)
+                continue
+            for tagging, person in zip(batch, people):
+                if person is not None:
+                    yield {"tagging": tagging, "person": person}
+
+    def due_at(self, tagging):
+        modified = datetime.strptime(tagging['modified_date'], '%Y-%m-%dT%H:%M:%SZ')
+        # A second past the delay, as the delay has to be strictly exceeded
+        due = modified + timedelta(minutes=self.delay_mins, seconds=1)
+        return due.replace(tzinfo=timezone.utc)
+
+    def oldest_tagging_age(self, taggings):
+        # Seconds the longest waiting supporter has been waiting
+        if not taggings:
+            return None
+        oldest = min(tagging['modified_date'] for tagging in taggings)
+        return (datetime.utcnow() - datetime.strptime(oldest, '%Y-%m-%dT%H:%M:%SZ')).total_seconds()
+
+    def _is_due(self, tagging, person):
+        target_index = self._get_target_index(person)
+        # modified_date is UTC, so the same due time the scheduler uses
+        return target_index == 0 or datetime.now(timezone.utc) >= self.due_at(tagging)
+
+    def process_people(self, people):
+        self.deferred_taggings = []
+        self.messages = self._load_messages()
+        self.target_allocator = self._load_target_allocator()
+        processed = 0
+        try:
+            for person in people:
+                taggings = self._trigger_taggings(person)
+                self.mirror_taggings(taggings)
+                if len(taggings) == 0:
+                    # Not tagged yet, or already handled; the poll reconciles
+                    continue
+                person = self.new_people([{"person_id": person["id"]}])[0]
+                if person is None:
+                    # Deleted since the webhook was sent
+                    continue
+                if not self._is_due(taggings[0], person):
+                    # Still inside delay_mins, scheduled for when it's due
+                    self.deferred_taggings.extend(taggings)
+                    continue
+                self.assign_target(person)
+                self.delete_taggings(taggings)
+                processed += 1
+        finally:
+            self.close()
+            self.flush_target_updates()
+        self.log(f"Processing complete for {processed} webhook people.")
+        return processed
+
+    def _trigger_taggings(self, person):
+        return [
+            tagging for tagging in self.an.iter_all(f"people/{person['id']}/taggings", fields=self.TAGGING_FIELDS)
+            if tagging.get("tag_id") == self.trigger_tag_id
+        ]
 
     def new_taggings(self):
-        taggings = self.an.get_all(f"tags/{self.trigger_tag_id}/taggings")
-        return taggings
+        with phase_timer("taggings_fetch"):
+            return self._fetch_taggings()
+
+    def _fetch_taggings(self):
+        resource = f"tags/{self.trigger_tag_id}/taggings"
+        if not self.watermark:
+            return self.an.get_all(resource, max_workers=self.page_workers, fields=self.TAGGING_FIELDS)
+        taggings = self.an.get_all(resource, max_workers=self.page_workers, fields=self.TAGGING_FIELDS, params={
+            "filter": f"modified_date gt '{self._watermark_filter()}'"
+        })
+        seen = set(tagging.id for tagging in taggings)
+        pending_ids = [id for id in self.pending_tagging_ids if id not in seen]
+        # Pending taggings that have since been deleted come back as None
+        pending = self.run_async(self._get_resources(resource, pending_ids, fields=self.TAGGING_FIELDS))
+        return taggings + [tagging for tagging in pending if tagging]
 
     def new_people(self, taggings):
-        people = [self.an.get("people", tagging["person_id"])
-                  for tagging in taggings]
-        return people
+        person_ids = [tagging["person_id"] for tagging in taggings]
+        with phase_timer("people_fetch"):
+            # People waiting out delay_mins come from the cache on later polls
+            people = self.person_cache.get_many(person_ids)
+            missing = list(dict.fromkeys(id for id in person_ids if id not in people))
+            hits = len(person_ids) - len(missing)
+            if self.mirror and missing:
+                # Known target indexes are all a person is fetched for
+                mirrored = self.mirror.lookup_target_indexes(self.mirror_prefixes, missing)
+                people.update((id, self._mirrored_person(id, mirrored[id])) for id in mirrored)
+                missing = [id for id in missing if id not in mirrored]
+            fetched = self.run_async(self._get_people(missing))
+            found = [person for person in fetched if person is not None]
+            self.person_cache.set_many(found)
+            if self.mirror:
+                self.mirror.record_people(self.mirror_prefixes, found)
+            people.update(zip(missing, fetched))
+        record_person_cache(hits, len(person_ids) - hits)
+        return [people.get(id) for id in person_ids]
+
+    def _mirrored_person(self, person_id, target_indexes):
+        return Person.from_json({
+            "custom_fields": {
+                f"{prefix}_target_index": index for prefix, index in target_indexes.items() if index
+            },
+            "_links": {"self": {"href": urllib.parse.urljoin(self.an.base_url, f"people/{person_id}")}}
+        }, self.PERSON_FIELDS)
+
+    async def _get_people(self, person_ids):
+        return await self._get_resources("people", person_ids, fields=self.PERSON_FIELDS)
+
+    async def _get_resources(self, resource, ids, **kwargs):
+        if len(ids) == 0:
+            return []
+        if self.async_an is None:
+            # Opens its session on the first request, inside self.loop
+            self.async_an = AsyncActionNetwork(
+                key=self.an_key, pool_size=self.people_concurrency, base_url=self.an.base_url,
+                rate_limiter=self.an.rate_limiter, circuit_breaker=self.an.circuit_breaker,
+                concurrency=self.an.concurrency)
+            self.async_an.request_hooks = self.an.request_hooks
+        return await self.async_an.get_many(resource, ids, **kwargs)
+
+    def _watermark_filter(self):
+        # Step back a second so taggings modified in the same second as the
+        # watermark aren't missed; processed ones are already deleted
+        watermark = datetime.strptime(self.watermark, '%Y-%m-%dT%H:%M:%SZ')
+        return (watermark - timedelta(seconds=1)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def advance_watermark(self, taggings):
+        dates = [tagging['modified_date'] for tagging in taggings]
+        if self.watermark:
+            dates.append(self.watermark)
+        if dates:
+            self.watermark = max(dates)
 
     def delete_taggings(self, taggings):
         for tagging in taggings:
             self.an._delete(tagging["_links"]["self"]["href"])
+            if self.mirror:
+                self.mirror.tagging_done(tagging["id"])
+
+    def mirror_taggings(self, taggings):
+        if self.mirror:
+            self.mirror.record_taggings(self.trigger_tag_id, taggings)
+
+    def flush_mirror(self):
+        if self.mirror:
+            self.mirror.flush()
 
     def assign_target(self, person):
+        assignment = self.compute_assignment(person)
+        person_updated = self.write_assignment(assignment)
+        self.record_assignment(assignment)
+        return person_updated
+
+    def compute_assignment(self, person):
         self.current_person = person
         target_index = self._get_target_index(person)
         # Get next target in view
         target = self._get_target()
         # Get next message in view
-        messages = self.airtable.all(
-            self.airtable_base,
-            self.airtable_message_table,
-            view=self.airtable_message_view,
-            formula=f"OR({{Pin}}=TRUE(), {{Previous Emails}}={target_index})"
-        )
-        message = "" if len(
-            messages) == 0 else messages[0]['fields'].get('HTML Content')
+        if self.messages is None:
+            self.messages = self._load_messages()
+        message = self.messages.message(target_index)
         # Create object to update person with prefix
         update = {
             "next_email": target['email'],
@@ -82,18 +348,18 @@ class RollingEmailer():
             "next_message": message,
             "target_index": target_index + 1
         }
+        return {"person": person, "update": update, "targets": self.targets}
+
+    def write_assignment(self, assignment):
+        person = assignment["person"]
         # update person
-        person_updated = self.an.put(
-            f"people/{person['id']}", json=self._make_person_update(update)).json()
-        # Update target on airtable
-        for at_target in self.targets:
-            contacts_sent_to = list(at_target['fields'].get(
-                'Contact Sent To')) if at_target['fields'].get('Contact Sent To') else []
-            contacts_sent_to.append(person["_links"]["self"]["href"])
-            self.airtable.update(self.airtable_base, self.airtable_target_table, at_target['id'], {
-                "Emails Sent Manual": int(at_target['fields'].get('Emails Sent Manual')) + 1,
-                "Contact Sent To": contacts_sent_to
-            }, typecast=True)
+        self.person_cache.invalidate(person["id"])
+        res = self.an.put(f"people/{person['id']}", json=self._make_person_update(assignment["update"]))
+        if res.status_code != 200:
+            raise ActionNetworkError(
+                f"PUT people/{person['id']} returned status {res.status_code}", res)
+        person_updated = res.json()
+        self.person_cache.set_many([Person.from_json(person_updated, self.PERSON_FIELDS)])
         # add end tag
         self.an.post(f"tags/{self.end_tag_id}/taggings", json={
             "_links": {
@@ -104,6 +370,30 @@ class RollingEmailer():
         })
         return person_updated
 
+    def record_assignment(self, assignment):
+        # Queue target updates for the next Airtable batch
+        self.target_allocator.commit(
+            assignment["targets"], assignment["person"]["_links"]["self"]["href"])
+        if self.mirror:
+            self.mirror.record_assignment(self.prefix, assignment)
+
+    def flush_target_updates(self):
+        if self.target_allocator:
+            self.target_allocator.flush()
+        self.flush_mirror()
+
+    def _load_target_allocator(self):
+        return TargetAllocator(self.airtable, self.airtable_base, self.airtable_target_table,
+                               self.airtable_target_view).load()
+
+    def shared_target_allocator(self, run_key):
+        return SharedTargetAllocator(get_redis(), run_key, self.airtable, self.airtable_base,
+                                     self.airtable_target_table, self.airtable_target_view)
+
+    def _load_messages(self):
+        return load_messages(self.airtable, self.airtable_base, self.airtable_message_table,
+                             self.airtable_message_view, redis=get_redis(), ttl=self.message_cache_ttl)
+
     def _make_person_update(self, update):
         person_update = {
             "custom_fields": {}
@@ -113,8 +403,9 @@ class RollingEmailer():
         return person_update
 
     def _get_target(self):
-        self.targets = self.airtable.all(self.airtable_base, self.airtable_target_table,
-                                         view=self.airtable_target_view, max_records=self.targets_each)
+        if self.target_allocator is None:
+            self.target_allocator = self._load_target_allocator()
+        self.targets = self.target_allocator.allocate(self.targets_each)
         target_list = {
             "email": [],
             "first_name": [],
@@ -0,0 +1,54 @@
+import json
+
+MESSAGE_FIELDS = ["Pin", "Previous Emails", "HTML Content"]
+
+
+class MessageIndex():
+    def __init__(self, records):
+        # (view position, content) so the pinned message only wins when it
+        # comes first in the view, as with the old OR() formula
+        self.pinned = None
+        self.by_previous = {}
+        for position, record in enumerate(records):
+            fields = record['fields']
+            entry = (position, fields.get('HTML Content'))
+            if fields.get('Pin') and self.pinned is None:
+                self.pinned = entry
+            previous = self._as_int(fields.get('Previous Emails'))
+            if previous is not None and previous not in self.by_previous:
+                self.by_previous[previous] = entry
+
+    def message(self, target_index):
+        matches = [entry for entry in [self.pinned, self.by_previous.get(target_index)] if entry]
+        if len(matches) == 0:
+            return ""
+        return min(matches, key=lambda entry: entry[0])[1]
+
+    def _as_int(self, value):
+        try:
+            return int(float(value))
+        except (TypeError, ValueError):
+            return None
+
+
+def cache_key(base, table, view):
+    return f"airtable:messages:{base}:{table}:{view}"
+
+
+def load_messages(airtable, base, table, view, redis=None, ttl=0):
+    key = cache_key(base, table, view)
+    if redis is not None and ttl:
+        cached = redis.get(key)
+        if cached:
+            return MessageIndex(json.loads(cached))
+    records = [
+        {"id": record["id"], "fields": record["fields"]}
+        for record in airtable.all(base, table, view=view, fields=MESSAGE_FIELDS)
+    ]
+    if redis is not None and ttl:
+        redis.set(key, json.dumps(records), ex=ttl)
+    return MessageIndex(records)
+
+
+def invalidate_messages(redis, base, table, view):
+    redis.delete(cache_key(base, table, view))
@@ -1,13 +1,25 @@
-from flask import Flask, render_template, redirect, request
+# Loaded before the imports below, which read their settings at import
+from dotenv import load_dotenv
+load_dotenv()
+
+from flask import Flask, render_template, redirect, request, Response
 from flask_babelex import Babel
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_user import current_user, login_required, roles_required, UserManager, UserMixin
 from flask_user.signals import user_registered
-from action_network import ActionNetwork
-from tasks import process_emailer
+from clients import get_action_network
+from tasks import queue_people, trigger_group, coalesced_triggers, refresh_tags_cache
+from tags_cache import fetch_tags, store_tags, load_tags, claim_refresh, invalidate_tags, search_tags
+from webhooks import people_from_webhook, WebhookPayloadError
+from redis_client import get_redis, REDIS_URL
+from airtable_messages import invalidate_messages
+from metrics import metrics_registry
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 import os
 import uuid
+import json
+from datetime import datetime, timedelta
 
 # Class-based application configuration
 
@@ -41,8 +53,8 @@ class ConfigClass(object):
     USER_EMAIL_SENDER_EMAIL = os.environ.get("USER_EMAIL_SENDER_EMAIL")
 
     # Celery
-    CELERY_BROKER_URL = 'redis://redis:6379',
-    CELERY_RESULT_BACKEND = 'redis://redis:6379'
+    CELERY_BROKER_URL = REDIS_URL,
+    CELERY_RESULT_BACKEND = REDIS_URL
 
 
 app = Flask(__name__)
@@ -116,6 +128,8 @@ class ActionNetworkCredential(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
     key = db.Column(db.String, nullable=False)
+    # Requests per second shared by every client using this key
+    rate_limit = db.Column(db.Float, default=4, server_default='4')
 
     created_by_id = db.Column(
         db.Integer, db.ForeignKey("users.id"), nullable=False)
@@ -124,7 +138,8 @@ class ActionNetworkCredential(db.Model):
         return {
             "id": self.id,
             "name": self.name,
-            "key": self.key
+            "key": self.key,
+            "rate_limit": self.rate_limit
         }
 
 
@@ -145,13 +160,64 @@ class RollingEmailer(db.Model):
     # Webhook address to trigger
     webhook = db.Column(db.String, default=str(uuid.uuid4()))
 
+    # Latest tagging modified_date seen, and JSON list of deferred tagging ids
+    tagging_watermark = db.Column(db.String)
+    pending_taggings = db.Column(db.Text)
+
+    runs = db.relationship('RollingEmailerRun', backref='rolling_emailer',
+                           lazy='dynamic', cascade='all, delete-orphan')
+    assignments = db.relationship('Assignment', backref='rolling_emailer',
+                                  lazy='dynamic', cascade='all, delete-orphan')
+
+    def coalesced_triggers(self):
+        return coalesced_triggers(self.id)
+
+    def group(self):
+        # Emailers that see the same taggings and so run together
+        return [emailer.to_dict() for emailer in RollingEmailer.query.filter_by(
+            action_network_api_key=self.action_network_api_key,
+            trigger_tag_id=self.trigger_tag_id
+        ).order_by(RollingEmailer.id)]
+
+    def pending_taggings_count(self):
+        return MirroredTagging.query.filter_by(
+            tag_id=self.trigger_tag_id, status="pending").count()
+
+    def assignments_since(self, hours=24):
+        since = datetime.utcnow() - timedelta(hours=hours)
+        return self.assignments.filter(Assignment.assigned_at >= since).count()
+
+    def recent_runs(self, limit=10):
+        return self.runs.order_by(RollingEmailerRun.started_at.desc()).limit(limit).all()
+
+    def backlog_trend(self, window=5):
+        # Compares taggings waiting at the start of the latest polls, alone
+        # or as part of a group, with the ones before; growing means runs
+        # are not keeping up
+        runs = self.runs.filter(RollingEmailerRun.kind.in_(["poll", "group"])).order_by(
+            RollingEmailerRun.started_at.desc()).limit(window * 2).all()
+        if len(runs) < window * 2:
+            return "not enough runs"
+        recent = sum(run.taggings_seen or 0 for run in runs[:window]) / window
+        earlier = sum(run.taggings_seen or 0 for run in runs[window:]) / window
+        if recent > earlier * 1.2 and recent - earlier >= 1:
+            return f"growing ({earlier:.0f} to {recent:.0f} per run)"
+        if recent < earlier * 0.8:
+            return f"shrinking ({earlier:.0f} to {recent:.0f} per run)"
+        return f"steady (about {recent:.0f} per run)"
+
+    def credential(self):
+        return ActionNetworkCredential.query.filter_by(key=self.action_network_api_key).first()
+
     def to_dict(self, public=False):
         if public:
             return {
                 'id': self.id,
-                'prefix': self.prefix
+                'prefix': self.prefix,
+                'coalesced_triggers': self.coalesced_triggers()
             }
         else:
+            credential = self.credential()
             return {
                 'id': self.id,
                 'prefix': self.prefix,
@@ -162,10 +228,133 @@ class RollingEmailer(db.Model):
                 'action_network_api_key': self.action_network_api_key,
                 'webhook': self.webhook,
                 'targets_each': self.targets_each,
-                'delay_mins': self.delay_mins
+                'delay_mins': self.delay_mins,
+                'rate_limit': credential.rate_limit if credential else None,
+                'tagging_watermark': self.tagging_watermark,
+                'pending_taggings': json.loads(self.pending_taggings) if self.pending_taggings else []
             }
 
 
+class RollingEmailerRun(db.Model):
+    __tablename__ = 'rolling_emailer_run'
+    id = db.Column(db.Integer, primary_key=True)
+    rolling_emailer_id = db.Column(db.Integer, db.ForeignKey(
+        'rolling_emailer.id', ondelete='CASCADE'), nullable=False, index=True)
+    # poll, webhook or deferred
+    kind = db.Column(db.String, default="poll")
+    status = db.Column(db.String, default="running")
+    started_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    finished_at = db.Column(db.DateTime)
+    taggings_seen = db.Column(db.Integer, default=0)
+    # Seconds since the oldest tagging in the run was added
+    oldest_tagging_age = db.Column(db.Float)
+    processed = db.Column(db.Integer, default=0)
+    deferred = db.Column(db.Integer, default=0)
+    api_calls = db.Column(db.Integer, default=0)
+    airtable_calls = db.Column(db.Integer, default=0)
+    # JSON object of phase name to seconds, summed over workers
+    phase_seconds = db.Column(db.Text)
+    # JSON list of error messages
+    errors = db.Column(db.Text)
+
+    def add_stats(self, stats):
+        self.api_calls = (self.api_calls or 0) + stats.get("api_calls", 0)
+        self.airtable_calls = (self.airtable_calls or 0) + stats.get("airtable_calls", 0)
+        phases = self.phases()
+        for phase, seconds in stats.get("phase_seconds", {}).items():
+            phases[phase] = phases.get(phase, 0) + seconds
+        self.phase_seconds = json.dumps(phases)
+
+    def add_errors(self, errors):
+        if errors:
+            self.errors = json.dumps(self.error_list() + list(errors))
+
+    def phases(self):
+        return json.loads(self.phase_seconds) if self.phase_seconds else {}
+
+    def error_list(self):
+        return json.loads(self.errors) if self.errors else []
+
+    def duration(self):
+        if self.finished_at and self.started_at:
+            return (self.finished_at - self.started_at).total_seconds()
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'rolling_emailer_id': self.rolling_emailer_id,
+            'kind': self.kind,
+            'status': self.status,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'duration': self.duration(),
+            'taggings_seen': self.taggings_seen,
+            'oldest_tagging_age': self.oldest_tagging_age,
+            'processed': self.processed,
+            'deferred': self.deferred,
+            'api_calls': self.api_calls,
+            'airtable_calls': self.airtable_calls,
+            'phase_seconds': self.phases(),
+            'errors': self.error_list()
+        }
+
+
+# Local mirror of Action Network state, kept up to date by mirror.py from
+# polls, webhooks and assignments
+
+
+class MirroredTagging(db.Model):
+    __tablename__ = 'mirrored_tagging'
+    id = db.Column(db.String, primary_key=True)
+    tag_id = db.Column(db.String)
+    person_id = db.Column(db.String, index=True)
+    modified_date = db.Column(db.String, index=True)
+    # pending until the tagging is deleted after processing
+    status = db.Column(db.String, default="pending")
+    seen_at = db.Column(db.DateTime, default=datetime.utcnow)
+    done_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_mirrored_tagging_tag_id_status', 'tag_id', 'status'),
+    )
+
+
+class PersonTargetIndex(db.Model):
+    __tablename__ = 'person_target_index'
+    person_id = db.Column(db.String, primary_key=True)
+    prefix = db.Column(db.String, primary_key=True)
+    target_index = db.Column(db.Integer, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class Assignment(db.Model):
+    __tablename__ = 'assignment'
+    id = db.Column(db.Integer, primary_key=True)
+    rolling_emailer_id = db.Column(db.Integer, db.ForeignKey(
+        'rolling_emailer.id', ondelete='CASCADE'), nullable=False)
+    person_id = db.Column(db.String, index=True)
+    tagging_id = db.Column(db.String)
+    target_index = db.Column(db.Integer)
+    # Target emails, comma separated
+    targets = db.Column(db.Text)
+    assigned_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_assignment_rolling_emailer_id_assigned_at', 'rolling_emailer_id', 'assigned_at'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'rolling_emailer_id': self.rolling_emailer_id,
+            'person_id': self.person_id,
+            'tagging_id': self.tagging_id,
+            'target_index': self.target_index,
+            'targets': self.targets,
+            'assigned_at': self.assigned_at.isoformat() if self.assigned_at else None
+        }
+
+
 # Create all database tables
 with app.app_context():
     db.create_all()
@@ -176,6 +365,11 @@ def index():
     return "Hello world"
 
 
+@app.route("/metrics")
+def metrics():
+    return Response(generate_latest(metrics_registry()), mimetype=CONTENT_TYPE_LATEST)
+
+
 @user_registered.connect_via(app)
 def _after_registration_hook(sender, user, **extra):
     print(f"User registered: {user.email}")
@@ -228,6 +422,9 @@ def action_network_credentials():
             key=body.get("key"),
             created_by_id=current_user.id
         )
+        # Left to the column default unless one is given
+        if body.get("rate_limit") is not None:
+            key.rate_limit = body["rate_limit"]
         db.session.add(key)
         db.session.commit()
         return key.to_dict()
@@ -237,15 +434,28 @@ def action_network_credentials():
 @roles_required('Admin')
 def get_action_network_tags(key_id):
     key_db = ActionNetworkCredential.query.get(key_id)
-    key = os.environ.get(key_db.key)
-    an = ActionNetwork(key=key)
-    tags = [
-        {
-            "id": tag["id"],
-            "name": tag["name"]
-        } for tag in an.get_all("tags")
-    ]
-    return tags
+    tags, stale = load_tags(get_redis(), key_id)
+    if tags is None:
+        an = get_action_network(os.environ.get(key_db.key), key_db.rate_limit)
+        tags = fetch_tags(an)
+        store_tags(get_redis(), key_id, tags)
+    elif stale and claim_refresh(get_redis(), key_id):
+        # Serve the stale list now and refresh it in the background
+        refresh_tags_cache.delay(key_id, key_db.key, key_db.rate_limit)
+    tags, total = search_tags(
+        tags,
+        prefix=request.args.get("q"),
+        page=request.args.get("page", type=int),
+        per_page=request.args.get("per_page", 100, type=int)
+    )
+    return tags, 200, {"X-Total-Count": str(total)}
+
+
+@app.route("/tags/<int:key_id>/invalidate", methods=["POST"])
+@roles_required('Admin')
+def invalidate_action_network_tags(key_id):
+    invalidate_tags(get_redis(), key_id)
+    return {"invalidated": key_id}
 
 
 @app.route("/rolling_emailer", methods=["POST", "GET"])
@@ -281,7 +491,34 @@ def rolling_emailers():
 @roles_required('Admin')
 def rolling_emailer(id):
     emailer = RollingEmailer.query.get(id)
-    process_emailer.delay(emailer.to_dict())
+    trigger_group(emailer.group())
+    return redirect("/rolling_emailer")
+
+
+@app.route("/rolling_emailer/<int:id>/runs")
+@roles_required('Admin')
+def rolling_emailer_runs(id):
+    emailer = RollingEmailer.query.get(id)
+    return [run.to_dict() for run in emailer.recent_runs(request.args.get("limit", 50, type=int))]
+
+
+@app.route("/rolling_emailer/<int:id>/assignments")
+@roles_required('Admin')
+def rolling_emailer_assignments(id):
+    emailer = RollingEmailer.query.get(id)
+    assignments = emailer.assignments
+    if request.args.get("person_id"):
+        assignments = assignments.filter_by(person_id=request.args["person_id"])
+    return [assignment.to_dict() for assignment in assignments.order_by(
+        Assignment.assigned_at.desc()).limit(request.args.get("limit", 100, type=int))]
+
+
+@app.route("/rolling_emailer/<int:id>/refresh_messages")
+@roles_required('Admin')
+def rolling_emailer_refresh_messages(id):
+    emailer = RollingEmailer.query.get(id)
+    invalidate_messages(get_redis(), os.environ.get("AIRTABLE_BASE"),
+                        os.environ.get("AIRTABLE_MESSAGE_TABLE"), emailer.message_view)
     return redirect("/rolling_emailer")
 
 
@@ -294,14 +531,25 @@ def rolling_emailer_delete(id):
     return redirect("/rolling_emailer")
 
 
-@app.route("/rolling_emailer/hook/<string:webhook>")
+@app.route("/rolling_emailer/hook/<string:webhook>", methods=["POST", "GET"])
 def rolling_emailer_hook(webhook):
     emailer = RollingEmailer.query.filter_by(webhook=webhook).first()
-    if emailer:
-        process_emailer.delay(emailer.to_dict())
-        return emailer.to_dict(public=True)
-    else:
+    if not emailer:
         return {"error": "Not found"}
+    people = []
+    if request.method == "POST":
+        try:
+            people = people_from_webhook(request.get_json(silent=True))
+        except WebhookPayloadError as e:
+            return {"error": str(e)}, 400
+    group = emailer.group()
+    if people and len(group) == 1:
+        # Only the people named in the payload; the poll stays as a fallback
+        queue_people(emailer.to_dict(), people)
+    else:
+        # Shared taggings are only deleted once the whole group is done
+        trigger_group(group)
+    return emailer.to_dict(public=True)
 
 
 if __name__ == "__main__":
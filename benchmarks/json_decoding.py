@@ -0,0 +1,131 @@
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import hal_parser
+from resources import Person, Tagging
+
+BASE = "https://actionnetwork.org/api/v2"
+CURIES = [{"name": "osdi", "href": "https://actionnetwork.org/docs/v2/{rel}", "templated": True}]
+
+
+def tagging(tag_id):
+    return {
+        "item_type": "osdi:person",
+        "created_date": "2023-01-01T00:00:00Z",
+        "modified_date": "2023-01-01T00:00:00Z",
+        "_links": {
+            "self": {"href": f"{BASE}/tags/{tag_id}/taggings/{uuid.uuid4()}"},
+            "osdi:tag": {"href": f"{BASE}/tags/{tag_id}"},
+            "osdi:person": {"href": f"{BASE}/people/{uuid.uuid4()}"},
+            "curies": CURIES
+        }
+    }
+
+
+def person(tag_id):
+    person_id = uuid.uuid4()
+    return {
+        "identifiers": [f"action_network:{person_id}"],
+        "given_name": "Test",
+        "family_name": "Person",
+        "email_addresses": [{"primary": True, "address": f"{person_id}@example.com", "status": "subscribed"}],
+        "postal_addresses": [{"primary": True, "postal_code": "AB1 2CD", "country": "GB",
+                              "location": {"latitude": 51.5, "longitude": -0.1, "accuracy": "Approximate"}}],
+        "languages_spoken": ["en"],
+        "custom_fields": {f"field_{i}": f"value {i}" for i in range(20)},
+        "created_date": "2023-01-01T00:00:00Z",
+        "modified_date": "2023-01-01T00:00:00Z",
+        "_links": {
+            "self": {"href": f"{BASE}/people/{person_id}"},
+            "osdi:attendances": {"href": f"{BASE}/people/{person_id}/attendances"},
+            "osdi:signatures": {"href": f"{BASE}/people/{person_id}/signatures"},
+            "osdi:submissions": {"href": f"{BASE}/people/{person_id}/submissions"},
+            "osdi:donations": {"href": f"{BASE}/people/{person_id}/donations"},
+            "osdi:outreaches": {"href": f"{BASE}/people/{person_id}/outreaches"},
+            "osdi:taggings": {"href": f"{BASE}/people/{person_id}/taggings"},
+            "curies": CURIES
+        }
+    }
+
+
+def page(slug, make, size):
+    tag_id = uuid.uuid4()
+    return json.dumps({
+        "total_pages": 40,
+        "per_page": size,
+        "page": 1,
+        "total_records": size * 40,
+        "_links": {
+            "next": {"href": f"{BASE}/{slug}?page=2"},
+            "self": {"href": f"{BASE}/{slug}?page=1"},
+            "curies": CURIES
+        },
+        "_embedded": {f"osdi:{slug}": [make(tag_id) for _ in range(size)]}
+    }).encode()
+
+
+def decode_stdlib(content, slug, resource_class, fields):
+    page = json.loads(content)
+    return [resource_class.from_json(item, fields) for item in page["_embedded"][slug]]
+
+
+def decode_orjson(content, slug, resource_class, fields):
+    page = hal_parser.orjson.loads(content)
+    return [resource_class.from_json(item, fields) for item in page["_embedded"][slug]]
+
+
+def decode_incremental(content, slug, resource_class, fields):
+    return [resource_class.from_json(item, fields)
+            for item in hal_parser.iter_embedded(content, slug, {})]
+
+
+def measure(decode, content, slug, resource_class, fields, rounds):
+    decode(content, slug, resource_class, fields)
+    start = time.process_time()
+    for _ in range(rounds):
+        decode(content, slug, resource_class, fields)
+    cpu = (time.process_time() - start) / rounds
+    # Started after the page is built, so only decoding counts
+    tracemalloc.start()
+    result = decode(content, slug, resource_class, fields)
+    kept, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return cpu, peak, kept
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare page decoders on synthetic Action Network pages")
+    parser.add_argument("--sizes", default="25,100", help="Comma separated items per page")
+    parser.add_argument("--rounds", type=int, default=500)
+    args = parser.parse_args()
+
+    decoders = [("json.loads", decode_stdlib), ("incremental", decode_incremental)]
+    if hal_parser.orjson is not None:
+        decoders.insert(1, ("orjson", decode_orjson))
+    cases = [
+        ("taggings", tagging, Tagging, ("modified_date",)),
+        ("people", person, Person, ("custom_fields",))
+    ]
+    print(f"{'page':<16}{'KB':>7}{'decoder':>14}{'CPU us':>10}{'peak KB':>10}{'kept KB':>10}")
+    for size in [int(size) for size in args.sizes.split(",")]:
+        for slug, make, resource_class, fields in cases:
+            content = page(slug, make, size)
+            for name, decode in decoders:
+                cpu, peak, kept = measure(decode, content, f"osdi:{slug}", resource_class,
+                                          fields, args.rounds)
+                print(f"{f'{size} {slug}':<16}{len(content) / 1024:>7.1f}{name:>14}"
+                      f"{cpu * 1e6:>10.0f}{peak / 1024:>10.1f}{kept / 1024:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from stubs import serve, ActionNetworkHandler, AirtableHandler
+
+SCENARIOS = ["get_all", "get_all_compact", "get_all_parallel", "process"]
+
+
+def control(server_url, action, body=None):
+    req = urllib.request.Request(
+        f"{server_url}/_control/{action}",
+        data=json.dumps(body or {}).encode(),
+        headers={"Content-Type": "application/json"},
+        method="POST"
+    )
+    with urllib.request.urlopen(req) as res:
+        return json.loads(res.read())
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run_scenario(scenario, size, an_url, airtable_url, stub, results):
+    # Runs in a fresh spawned process so peak RSS belongs to this scenario only
+    os.environ.update({
+        "BENCH_ACTION_NETWORK_KEY": "bench",
+        "AIRTABLE_API_KEY": "bench",
+        "AIRTABLE_BASE": "appBench",
+        "AIRTABLE_TARGET_TABLE": "Targets",
+        "AIRTABLE_MESSAGE_TABLE": "Messages",
+        "AIRTABLE_MESSAGE_CACHE_TTL": "0",
+        "PERSON_CACHE_BACKEND": "memory",
+        "AIRTABLE_TARGET_WRITE_LOCK": "0"
+    })
+    from action_network import ActionNetwork
+    latencies = []
+    an = ActionNetwork(key="bench", base_url=f"{an_url}/api/v2/", pool_maxsize=16)
+    an.request_hooks.append(
+        lambda method, url, res, elapsed, attempt: latencies.append(elapsed))
+    resource_name = f"tags/{stub['trigger_tag_id']}/taggings"
+    start = time.perf_counter()
+    if scenario == "get_all":
+        items = len(an.get_all(resource_name))
+    elif scenario == "get_all_compact":
+        items = len(an.get_all(resource_name, fields=("modified_date",)))
+    elif scenario == "get_all_parallel":
+        items = len(an.get_all(resource_name, max_workers=8))
+    else:
+        import pyairtable as airtable
+        from clients import airtable_retry_strategy
+        from action_network_rolling_emails import RollingEmailer
+        emailer = RollingEmailer(stub['trigger_tag_id'], "Grid view", "Grid view", "bench",
+                                 stub['tag_ids'][1], an_key="BENCH_ACTION_NETWORK_KEY")
+        # Point the emailer at the stubs, without the Redis-backed breaker
+        emailer.an = an
+        emailer.airtable = airtable.Api("bench", retry_strategy=airtable_retry_strategy())
+        emailer.airtable.API_URL = f"{airtable_url}/v0"
+        items = emailer.process()
+    elapsed = time.perf_counter() - start
+    results.put({
+        "scenario": scenario,
+        "size": size,
+        "items": items,
+        "seconds": elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the Action Network client and RollingEmailer against local stubs")
+    parser.add_argument("--sizes", default="100,10000,100000",
+                        help="Comma separated tagging counts")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds added to every stub response")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="Up to this many extra random seconds per response")
+    parser.add_argument("--an-rate", type=float, default=0,
+                        help="Action Network stub requests per second, 0 for unlimited")
+    parser.add_argument("--airtable-rate", type=float, default=5,
+                        help="Airtable stub requests per second, 0 for unlimited")
+    parser.add_argument("--targets", type=int, default=50)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON lines")
+    args = parser.parse_args()
+
+    an_server = serve(ActionNetworkHandler, latency=args.latency,
+                      jitter=args.jitter, rate=args.an_rate)
+    airtable_server = serve(AirtableHandler, latency=args.latency,
+                            jitter=args.jitter, rate=args.airtable_rate)
+    context = multiprocessing.get_context("spawn")
+
+    if not args.json:
+        print(f"{'scenario':<18}{'size':>8}{'seconds':>10}{'items/s':>10}{'AN reqs':>9}"
+              f"{'AT reqs':>9}{'p50 ms':>9}{'p99 ms':>9}{'RSS MB':>9}")
+    for size in [int(size) for size in args.sizes.split(",")]:
+        for scenario in args.scenarios.split(","):
+            stub = control(an_server.url, "reset", {"tags": 2, "taggings": size})
+            control(airtable_server.url, "reset", {"targets": args.targets})
+            results = context.Queue()
+            process = context.Process(target=run_scenario, args=(
+                scenario, size, an_server.url, airtable_server.url, stub, results))
+            process.start()
+            result = results.get()
+            process.join()
+            result["action_network_requests"] = control(an_server.url, "stats")
+            result["airtable_requests"] = control(airtable_server.url, "stats")
+            if args.json:
+                print(json.dumps(result))
+                continue
+            print(f"{scenario:<18}{size:>8}{result['seconds']:>10.2f}"
+                  f"{result['items'] / result['seconds']:>10.0f}"
+                  f"{sum(result['action_network_requests'].values()):>9}"
+                  f"{sum(result['airtable_requests'].values()):>9}"
+                  f"{result['p50_ms']:>9.1f}{result['p99_ms']:>9.1f}{result['peak_rss_mb']:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
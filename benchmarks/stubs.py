@@ -0,0 +1,311 @@
+import json
+import random
+import re
+import socket
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class RateLimit():
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        # Returns seconds until a request would be allowed, 0 if it is
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 drops SYNs when clients open pools at once
+    request_queue_size = 128
+
+    def __init__(self, address, handler, latency=0, jitter=0, rate=0):
+        super().__init__(address, handler)
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = RateLimit(rate)
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    RETRY_AFTER = True
+
+    def setup(self):
+        super().setup()
+        # Headers and body go out as separate writes; don't let Nagle hold them
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_PATCH(self):
+        self._handle("PATCH")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    def _handle(self, method):
+        url = urllib.parse.urlparse(self.path)
+        path = [part for part in url.path.split("/") if part]
+        query = dict(urllib.parse.parse_qsl(url.query))
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        if path[:1] == ["_control"]:
+            return self._send(200, self.control(method, path[1:], body))
+        wait = self.server.rate_limit.take()
+        if wait:
+            self.server.count((method, "429"))
+            headers = {"Retry-After": f"{wait:.3f}"} if self.RETRY_AFTER else None
+            return self._send(429, {"error": "rate limited"}, headers)
+        if self.server.latency or self.server.jitter:
+            time.sleep(self.server.latency + random.uniform(0, self.server.jitter))
+        status, response, route = self.route(method, path, query, body)
+        self.server.count((method, route))
+        self._send(status, response)
+
+    def control(self, method, path, body):
+        if path == ["stats"]:
+            return {" ".join(key): count for key, count in self.server.counts.items()}
+        if path == ["reset"]:
+            with self.server.lock:
+                self.server.counts = {}
+            self.reset(body or {})
+            return {"reset": True}
+        return {}
+
+    def _send(self, status, response, headers=None):
+        content = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class ActionNetworkHandler(StubHandler):
+    # Emulates the HAL collections the rolling emailer touches:
+    # tags, tags/{id}/taggings and people
+    PER_PAGE = 25
+
+    def reset(self, config):
+        state = self.server.state = {"tags": {}, "taggings": {}, "people": {}}
+        base = f"{self.server.url}/api/v2"
+        self.server.base = base
+        for i in range(config.get("tags", 1)):
+            tag_id = str(uuid.uuid4())
+            state["tags"][tag_id] = self._tag(tag_id, f"Tag {i}")
+            state["taggings"][tag_id] = {}
+        self.server.trigger_tag_id = next(iter(state["tags"]))
+        modified = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() - 3600))
+        for _ in range(config.get("taggings", 0)):
+            person_id = str(uuid.uuid4())
+            state["people"][person_id] = self._person(person_id)
+            self._add_tagging(self.server.trigger_tag_id, person_id, modified)
+
+    def control(self, method, path, body):
+        response = super().control(method, path, body)
+        if path == ["reset"]:
+            response["trigger_tag_id"] = self.server.trigger_tag_id
+            response["tag_ids"] = list(self.server.state["tags"])
+        return response
+
+    def route(self, method, path, query, body):
+        state = self.server.state
+        path = path[2:] if path[:2] == ["api", "v2"] else path
+        if path == ["tags"] and method == "GET":
+            return self._page("tags", list(state["tags"].values()), query) + ("tags",)
+        if len(path) >= 3 and path[0] == "tags" and path[2] == "taggings":
+            taggings = state["taggings"].get(path[1], {})
+            if len(path) == 3 and method == "GET":
+                items = list(taggings.values())
+                if query.get("filter", "").startswith("modified_date gt "):
+                    since = query["filter"].split("'")[1]
+                    items = [item for item in items if item["modified_date"] > since]
+                return self._page("taggings", items, query) + ("taggings",)
+            if len(path) == 3 and method == "POST":
+                person_id = body["_links"]["osdi:person"]["href"].split("/")[-1]
+                now = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+                return 200, self._add_tagging(path[1], person_id, now), "tagging"
+            if len(path) == 4 and method == "GET":
+                tagging = taggings.get(path[3])
+                return (200, tagging, "tagging") if tagging else (404, {}, "tagging")
+            if len(path) == 4 and method == "DELETE":
+                taggings.pop(path[3], None)
+                return 200, {"notice": "deleted"}, "tagging"
+        if path[:1] == ["people"] and len(path) == 2:
+            person = state["people"].get(path[1])
+            if person is None:
+                return 404, {}, "person"
+            if method == "PUT":
+                person["custom_fields"].update(body.get("custom_fields", {}))
+            return 200, person, "person"
+        return 404, {"error": "not found"}, "unknown"
+
+    def _page(self, slug, items, query):
+        page = int(query.get("page", 1))
+        total_pages = max(1, -(-len(items) // self.PER_PAGE))
+        start = (page - 1) * self.PER_PAGE
+        links = {"self": {"href": self._page_url(slug, query, page)}}
+        if page < total_pages:
+            links["next"] = {"href": self._page_url(slug, query, page + 1)}
+        return 200, {
+            "total_pages": total_pages,
+            "per_page": self.PER_PAGE,
+            "page": page,
+            "total_records": len(items),
+            "_links": links,
+            "_embedded": {f"osdi:{slug}": items[start:start + self.PER_PAGE]}
+        }
+
+    def _page_url(self, slug, query, page):
+        query = dict(query, page=page)
+        return f"{self.server.url}{urllib.parse.urlparse(self.path).path}?{urllib.parse.urlencode(query)}"
+
+    def _tag(self, tag_id, name):
+        return {
+            "name": name,
+            "created_date": "2023-01-01T00:00:00Z",
+            "modified_date": "2023-01-01T00:00:00Z",
+            "_links": {
+                "self": {"href": f"{self.server.base}/tags/{tag_id}"},
+                "osdi:taggings": {"href": f"{self.server.base}/tags/{tag_id}/taggings"},
+                "curies": [{"name": "osdi", "href": "https://actionnetwork.org/docs/v2/{rel}", "templated": True}]
+            }
+        }
+
+    def _person(self, person_id):
+        return {
+            "given_name": "Test",
+            "family_name": "Person",
+            "email_addresses": [{"primary": True, "address": f"{person_id}@example.com", "status": "subscribed"}],
+            "custom_fields": {},
+            "created_date": "2023-01-01T00:00:00Z",
+            "modified_date": "2023-01-01T00:00:00Z",
+            "_links": {
+                "self": {"href": f"{self.server.base}/people/{person_id}"},
+                "osdi:taggings": {"href": f"{self.server.base}/people/{person_id}/taggings"},
+                "osdi:signatures": {"href": f"{self.server.base}/people/{person_id}/signatures"},
+                "curies": [{"name": "osdi", "href": "https://actionnetwork.org/docs/v2/{rel}", "templated": True}]
+            }
+        }
+
+    def _add_tagging(self, tag_id, person_id, modified):
+        tagging_id = str(uuid.uuid4())
+        tagging = {
+            "item_type": "osdi:person",
+            "created_date": modified,
+            "modified_date": modified,
+            "_links": {
+                "self": {"href": f"{self.server.base}/tags/{tag_id}/taggings/{tagging_id}"},
+                "osdi:tag": {"href": f"{self.server.base}/tags/{tag_id}"},
+                "osdi:person": {"href": f"{self.server.base}/people/{person_id}"},
+                "curies": [{"name": "osdi", "href": "https://actionnetwork.org/docs/v2/{rel}", "templated": True}]
+            }
+        }
+        self.server.state["taggings"].setdefault(tag_id, {})[tagging_id] = tagging
+        return tagging
+
+
+class AirtableHandler(StubHandler):
+    # Emulates the list (with view, formula and offset paging) and batch
+    # update endpoints of /v0/{base}/{table}
+    PAGE_SIZE = 100
+    # Airtable's 429s carry no Retry-After
+    RETRY_AFTER = False
+
+    def reset(self, config):
+        self.server.tables = {
+            "Targets": [
+                {"id": f"rec{i:014d}", "fields": {
+                    "Email": f"target{i}@example.com", "First Name": "Target", "Last Name": str(i),
+                    "Position": "MP", "Phone": "0", "Emails Sent Manual": 0}}
+                for i in range(config.get("targets", 50))
+            ],
+            "Messages": [
+                {"id": f"msg{i:014d}", "fields": {"Previous Emails": i, "HTML Content": f"<p>Email {i}</p>"}}
+                for i in range(config.get("messages", 5))
+            ]
+        }
+
+    def route(self, method, path, query, body):
+        table = self.server.tables.get(urllib.parse.unquote(path[2])) if len(path) >= 3 else None
+        if table is None:
+            return 404, {"error": "NOT_FOUND"}, "unknown"
+        if method == "GET":
+            records = table
+            if "RECORD_ID()" in query.get("filterByFormula", ""):
+                # OR(RECORD_ID()='rec...', ...) as targets are re-read before writing
+                ids = set(re.findall(r"RECORD_ID\(\)='(\w+)'", query["filterByFormula"]))
+                records = [record for record in table if record["id"] in ids]
+            elif query.get("filterByFormula"):
+                # Only the formulas the emailer has used: OR({Pin}=TRUE(), {Previous Emails}=n)
+                n = query["filterByFormula"].rsplit("=", 1)[-1].rstrip(")")
+                records = [record for record in table
+                           if record["fields"].get("Pin") or str(record["fields"].get("Previous Emails")) == n]
+            if table is self.server.tables["Targets"]:
+                records = sorted(records, key=lambda record: record["fields"].get("Emails Sent Manual") or 0)
+            if query.get("maxRecords"):
+                records = records[:int(query["maxRecords"])]
+            offset = int(query.get("offset", 0))
+            page = records[offset:offset + self.PAGE_SIZE]
+            response = {"records": page}
+            if offset + self.PAGE_SIZE < len(records):
+                response["offset"] = str(offset + self.PAGE_SIZE)
+            return 200, response, "list"
+        if method == "PATCH":
+            by_id = {record["id"]: record for record in table}
+            if len(path) == 4:
+                updates = [{"id": path[3], "fields": body["fields"]}]
+            else:
+                updates = body["records"]
+                if len(updates) > 10:
+                    return 422, {"error": "INVALID_RECORDS"}, "batch_update"
+            for update in updates:
+                by_id[update["id"]]["fields"].update(update["fields"])
+            route = "update" if len(path) == 4 else "batch_update"
+            return 200, {"records": [by_id[update["id"]] for update in updates]}, route
+        return 404, {"error": "NOT_FOUND"}, "unknown"
+
+
+def serve(handler, port=0, **options):
+    server = StubServer(("127.0.0.1", port), handler, **options)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
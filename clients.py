@@ -0,0 +1,70 @@
+import os
+import threading
+import time
+import pyairtable as airtable
+from action_network import ActionNetwork
+from redis_client import get_redis
+from throttling import TokenBucket, CircuitBreaker
+from metrics import record_request, InstrumentedAirtable
+
+IDLE_TIMEOUT = int(os.environ.get("CLIENT_IDLE_TIMEOUT", 600))
+# Matches the credential default, for keys with no rate limit stored
+DEFAULT_RATE_LIMIT = 4
+
+
+class ClientRegistry():
+    def __init__(self, idle_timeout):
+        self.idle_timeout = idle_timeout
+        self.reset()
+
+    def reset(self):
+        # Connections inherited over a fork belong to the parent; drop them
+        # without closing and build fresh clients in the child
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, factory):
+        with self.lock:
+            self._evict_idle()
+            entry = self.clients.get(key)
+            client = entry[0] if entry else factory()
+            self.clients[key] = (client, time.monotonic())
+            return client
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        for key, (client, last_used) in list(self.clients.items()):
+            # Dropped rather than closed, as a long run may still hold it
+            if now - last_used > self.idle_timeout:
+                del self.clients[key]
+
+
+registry = ClientRegistry(IDLE_TIMEOUT)
+os.register_at_fork(after_in_child=registry.reset)
+
+
+def get_action_network(api_key, rate_limit=None):
+    rate_limit = rate_limit or DEFAULT_RATE_LIMIT
+
+    def factory():
+        an = ActionNetwork(
+            key=api_key,
+            pool_maxsize=int(os.environ.get("ACTION_NETWORK_POOL_SIZE", 10)),
+            rate_limiter=TokenBucket(get_redis(), api_key, rate_limit),
+            circuit_breaker=CircuitBreaker(get_redis(), api_key),
+            stream_pages=bool(int(os.environ.get("ACTION_NETWORK_STREAM_PAGES", 0)))
+        )
+        an.request_hooks.append(record_request)
+        return an
+    return registry.get(("action_network", api_key, rate_limit), factory)
+
+
+def get_airtable(api_key):
+    return registry.get(("airtable", api_key),
+                        lambda: InstrumentedAirtable(airtable.Api(api_key, retry_strategy=airtable_retry_strategy())))
+
+
+def airtable_retry_strategy():
+    # Airtable allows 5 requests a second per base. Only 429s are retried,
+    # which are safe to repeat for any method, PATCH included
+    return airtable.retry_strategy(status_forcelist=(429,), allowed_methods=None)
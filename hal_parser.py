@@ -0,0 +1,91 @@
+import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+decoder = json.JSONDecoder()
+
+
+def loads(content):
+    # orjson when it's installed, the standard library otherwise
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+class Scanner():
+    # Walks a JSON document a value at a time with raw_decode, so only the
+    # values asked for are built
+    def __init__(self, text):
+        self.text = text
+        self.index = 0
+
+    def skip(self):
+        self.index = WHITESPACE.match(self.text, self.index).end()
+
+    def peek(self):
+        self.skip()
+        return self.text[self.index:self.index + 1]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected {char!r} at {self.index}")
+        self.index += 1
+
+    def value(self):
+        self.skip()
+        value, self.index = decoder.raw_decode(self.text, self.index)
+        return value
+
+    def members(self):
+        # Yields each key of an object; the caller reads or walks its value
+        # before asking for the next
+        self.expect("{")
+        if self.peek() == "}":
+            self.index += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            if self.peek() == ",":
+                self.index += 1
+                continue
+            self.expect("}")
+            return
+
+    def elements(self):
+        self.expect("[")
+        if self.peek() == "]":
+            self.index += 1
+            return
+        while True:
+            yield
+            if self.peek() == ",":
+                self.index += 1
+                continue
+            self.expect("]")
+            return
+
+
+def iter_embedded(content, slug, page=None):
+    # Yields the items of _embedded[slug] one at a time. Other top level
+    # fields (_links, total_pages...) are put in page as they are passed
+    text = content.decode("utf-8") if isinstance(content, bytes) else content
+    scanner = Scanner(text)
+    for key in scanner.members():
+        if key != "_embedded":
+            value = scanner.value()
+            if page is not None:
+                page[key] = value
+            continue
+        for collection in scanner.members():
+            if collection != slug:
+                scanner.value()
+                continue
+            for _ in scanner.elements():
+                yield scanner.value()
@@ -0,0 +1,157 @@
+import contextvars
+import os
+import re
+import threading
+import time
+import urllib.parse
+from contextlib import contextmanager
+from prometheus_client import Counter, Histogram, CollectorRegistry, REGISTRY, multiprocess
+
+# The web app and beat load the same settings without clearing the directory
+if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+# The rolling emailer whose work is being measured, if any
+current_emailer = contextvars.ContextVar("current_emailer", default="")
+
+
+class RunStats():
+    # Totals for one task of a run, kept alongside the Prometheus metrics so
+    # they can be stored with the run
+    def __init__(self, stats=None):
+        stats = stats or {}
+        self.lock = threading.Lock()
+        self.api_calls = stats.get("api_calls", 0)
+        self.airtable_calls = stats.get("airtable_calls", 0)
+        self.phase_seconds = dict(stats.get("phase_seconds", {}))
+
+    def add_api_call(self):
+        with self.lock:
+            self.api_calls += 1
+
+    def add_airtable_call(self):
+        with self.lock:
+            self.airtable_calls += 1
+
+    def add_phase(self, phase, seconds):
+        with self.lock:
+            self.phase_seconds[phase] = self.phase_seconds.get(phase, 0) + seconds
+
+    def to_dict(self):
+        return {
+            "api_calls": self.api_calls,
+            "airtable_calls": self.airtable_calls,
+            "phase_seconds": dict(self.phase_seconds)
+        }
+
+
+current_run_stats = contextvars.ContextVar("current_run_stats", default=None)
+
+UUID_REGEX = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+REQUEST_SECONDS = Histogram(
+    "action_network_request_seconds", "Action Network request latency",
+    ["endpoint", "method", "status", "emailer"])
+REQUEST_RETRIES = Counter(
+    "action_network_request_retries_total", "Action Network request retries",
+    ["endpoint", "method", "emailer"])
+RESPONSE_BYTES = Counter(
+    "action_network_response_bytes_total", "Action Network response body bytes",
+    ["endpoint", "method", "emailer"])
+AIRTABLE_SECONDS = Histogram(
+    "airtable_request_seconds", "Airtable call latency",
+    ["operation", "status", "emailer"])
+PHASE_SECONDS = Histogram(
+    "rolling_emailer_phase_seconds", "Time spent in each phase of a run",
+    ["phase", "emailer"])
+PERSON_CACHE_LOOKUPS = Counter(
+    "person_cache_lookups_total", "People looked up in the person cache",
+    ["result", "emailer"])
+
+
+def endpoint_label(url):
+    path = urllib.parse.urlparse(url).path
+    path = path.split("/api/v2/", 1)[-1]
+    return UUID_REGEX.sub("{id}", path)
+
+
+def record_request(method, url, res, elapsed, attempt):
+    endpoint = endpoint_label(url)
+    emailer = current_emailer.get()
+    status = str(res.status_code) if res is not None else "error"
+    REQUEST_SECONDS.labels(endpoint, method, status, emailer).observe(elapsed)
+    if attempt > 0:
+        REQUEST_RETRIES.labels(endpoint, method, emailer).inc()
+    if res is not None:
+        RESPONSE_BYTES.labels(endpoint, method, emailer).inc(len(res.content))
+    stats = current_run_stats.get()
+    if stats is not None:
+        stats.add_api_call()
+
+
+def record_person_cache(hits, misses):
+    emailer = current_emailer.get()
+    PERSON_CACHE_LOOKUPS.labels("hit", emailer).inc(hits)
+    PERSON_CACHE_LOOKUPS.labels("miss", emailer).inc(misses)
+
+
+@contextmanager
+def phase_timer(phase):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - start
+        PHASE_SECONDS.labels(phase, current_emailer.get()).observe(elapsed)
+        stats = current_run_stats.get()
+        if stats is not None:
+            stats.add_phase(phase, elapsed)
+
+
+class InstrumentedAirtable():
+    # Times every pyairtable Api call made through it
+    def __init__(self, api):
+        self.api = api
+
+    def __getattr__(self, name):
+        attr = getattr(self.api, name)
+        if not callable(attr):
+            return attr
+
+        def timed(*args, **kwargs):
+            start = time.monotonic()
+            status = "ok"
+            try:
+                return attr(*args, **kwargs)
+            except Exception:
+                status = "error"
+                raise
+            finally:
+                AIRTABLE_SECONDS.labels(name, status, current_emailer.get()).observe(
+                    time.monotonic() - start)
+                stats = current_run_stats.get()
+                if stats is not None:
+                    stats.add_airtable_call()
+        return timed
+
+
+def clear_multiprocess_dir():
+    # Run before any child process starts: files left by the last worker's
+    # children would otherwise be added to this one's totals
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if not path:
+        return
+    os.makedirs(path, exist_ok=True)
+    for name in os.listdir(path):
+        if name.endswith(".db"):
+            os.remove(os.path.join(path, name))
+
+
+def metrics_registry():
+    # Celery's prefork children each record their own metrics; with
+    # PROMETHEUS_MULTIPROC_DIR set they are aggregated from disk
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
@@ -0,0 +1,234 @@
+import os
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+
+ENABLED = bool(int(os.environ.get("EMAILER_SQL_MIRROR", 1)))
+# Past this, a stored index is refetched, so changes made in Action Network
+# (an admin resetting an index, say) are picked up
+MAX_AGE = int(os.environ.get("EMAILER_MIRROR_MAX_AGE", 86400))
+# Keeps IN () lists under SQLite's variable limit
+BATCH_SIZE = 500
+
+
+def batches(items):
+    items = list(items)
+    for i in range(0, len(items), BATCH_SIZE):
+        yield items[i:i + BATCH_SIZE]
+
+
+def dialect_insert(session):
+    # INSERT ... ON CONFLICT, for the databases that have it
+    name = session.get_bind().dialect.name
+    if name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+        return insert
+    if name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+        return insert
+    return None
+
+
+def upsert(session, insert, model, keys, rows, update, where=None):
+    for batch in batches(rows):
+        statement = insert(model)
+        statement = statement.on_conflict_do_update(
+            index_elements=keys,
+            set_={column: getattr(statement.excluded, column) for column in update},
+            where=where(statement) if where else None
+        )
+        session.execute(statement, batch)
+
+
+class SqlMirror():
+    # Buffers what a run learns about taggings, people and assignments and
+    # writes it to the mirror tables in app.py on flush. Models are imported
+    # lazily as app imports the tasks that create these
+    def __init__(self, emailer_id):
+        self.emailer_id = emailer_id
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.taggings = {}
+        self.done = set()
+        self.target_indexes = {}
+        self.fetched_indexes = {}
+        self.assignments = []
+
+    def record_taggings(self, tag_id, taggings):
+        with self.lock:
+            for tagging in taggings:
+                self.taggings[tagging["id"]] = (tag_id, tagging.get("person_id"), tagging.get("modified_date"))
+
+    def record_people(self, prefixes, people):
+        # The person's index for each prefix asked about, 0 if they have none
+        # yet, so the next lookup needn't fetch them. What Action Network
+        # returned replaces any row written before the fetch, lower or not
+        fetched_at = datetime.utcnow()
+        with self.lock:
+            for person in people:
+                custom_fields = person.get("custom_fields") or {}
+                for prefix in prefixes:
+                    self.fetched_indexes[(person["id"], prefix)] = (
+                        int(custom_fields.get(f"{prefix}_target_index") or 0), fetched_at)
+
+    def record_target_index(self, person_id, prefix, target_index):
+        # Assignments only raise an index
+        key = (person_id, prefix)
+        self.target_indexes[key] = max(target_index, self.target_indexes.get(key, 0))
+
+    def record_assignment(self, prefix, assignment):
+        person_id = assignment["person"]["id"]
+        update = assignment["update"]
+        with self.lock:
+            self.record_target_index(person_id, prefix, update["target_index"])
+            self.assignments.append({
+                "rolling_emailer_id": self.emailer_id,
+                "person_id": person_id,
+                "tagging_id": assignment.get("tagging_id"),
+                "target_index": update["target_index"],
+                "targets": update["next_email"],
+                "assigned_at": datetime.utcnow()
+            })
+
+    def tagging_done(self, tagging_id):
+        with self.lock:
+            self.done.add(tagging_id)
+
+    def lookup_target_indexes(self, prefixes, person_ids):
+        # {person_id: {prefix: target_index}} for the people with a fresh
+        # row for every one of the prefixes
+        from app import app, PersonTargetIndex
+        found = {}
+        cutoff = datetime.utcnow() - timedelta(seconds=MAX_AGE)
+        with app.app_context():
+            for batch in batches(set(person_ids)):
+                for row in PersonTargetIndex.query.filter(
+                        PersonTargetIndex.prefix.in_(prefixes),
+                        PersonTargetIndex.person_id.in_(batch),
+                        PersonTargetIndex.updated_at >= cutoff):
+                    found.setdefault(row.person_id, {})[row.prefix] = row.target_index
+        return {person_id: indexes for person_id, indexes in found.items()
+                if len(indexes) == len(set(prefixes))}
+
+    def flush(self):
+        with self.lock:
+            buffered = (self.taggings, self.done, self.target_indexes, self.fetched_indexes, self.assignments)
+            self.reset()
+        if not any(buffered):
+            return
+        from app import app, db
+        try:
+            with app.app_context():
+                try:
+                    self.write(db.session, *buffered)
+                except IntegrityError:
+                    # Another run inserted some of the same rows first;
+                    # they are found and updated the second time
+                    self.write(db.session, *buffered)
+        except Exception:
+            # Kept for the next flush rather than lost with this one
+            self.restore(*buffered)
+            raise
+
+    def restore(self, taggings, done, target_indexes, fetched_indexes, assignments):
+        with self.lock:
+            for id, tagging in taggings.items():
+                self.taggings.setdefault(id, tagging)
+            self.done |= done
+            for (person_id, prefix), target_index in target_indexes.items():
+                self.record_target_index(person_id, prefix, target_index)
+            for key, fetched in fetched_indexes.items():
+                # A fetch since the failed flush is the newer one
+                self.fetched_indexes.setdefault(key, fetched)
+            self.assignments[:0] = assignments
+
+    def write(self, session, taggings, done, target_indexes, fetched_indexes, assignments):
+        from app import Assignment
+        try:
+            now = datetime.utcnow()
+            insert = dialect_insert(session)
+            if insert is None:
+                self.merge_rows(session, now, taggings, done, target_indexes, fetched_indexes)
+            else:
+                self.upsert_rows(session, insert, now, taggings, done, target_indexes, fetched_indexes)
+            session.add_all([Assignment(**assignment) for assignment in assignments])
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+    def upsert_rows(self, session, insert, now, taggings, done, target_indexes, fetched_indexes):
+        from app import MirroredTagging, PersonTargetIndex
+        fields = ["tag_id", "person_id", "modified_date"]
+        rows = {"pending": [], "done": [], "done_only": []}
+        for id, (tag_id, person_id, modified_date) in taggings.items():
+            row = {"id": id, "tag_id": tag_id, "person_id": person_id,
+                   "modified_date": modified_date, "seen_at": now}
+            if id in done:
+                rows["done"].append(dict(row, status="done", done_at=now))
+            else:
+                rows["pending"].append(dict(row, status="pending"))
+        rows["done_only"] = [{"id": id, "seen_at": now, "status": "done", "done_at": now}
+                             for id in done if id not in taggings]
+        # A pending row never takes a done one back to pending
+        upsert(session, insert, MirroredTagging, ["id"], rows["pending"], fields)
+        upsert(session, insert, MirroredTagging, ["id"], rows["done"], fields + ["status", "done_at"])
+        upsert(session, insert, MirroredTagging, ["id"], rows["done_only"], ["status", "done_at"])
+        # Fetched indexes first, so this flush's assignments land on top
+        upsert(session, insert, PersonTargetIndex, ["person_id", "prefix"], [
+            {"person_id": person_id, "prefix": prefix, "target_index": target_index, "updated_at": fetched_at}
+            for (person_id, prefix), (target_index, fetched_at) in fetched_indexes.items()
+        ], ["target_index", "updated_at"],
+            where=lambda statement: or_(PersonTargetIndex.updated_at.is_(None),
+                                        PersonTargetIndex.updated_at <= statement.excluded.updated_at))
+        upsert(session, insert, PersonTargetIndex, ["person_id", "prefix"], [
+            {"person_id": person_id, "prefix": prefix, "target_index": target_index, "updated_at": now}
+            for (person_id, prefix), target_index in target_indexes.items()
+        ], ["target_index", "updated_at"],
+            where=lambda statement: PersonTargetIndex.target_index < statement.excluded.target_index)
+
+    def merge_rows(self, session, now, taggings, done, target_indexes, fetched_indexes):
+        from app import MirroredTagging, PersonTargetIndex
+        for batch in batches(set(taggings) | done):
+            existing = {row.id: row for row in MirroredTagging.query.filter(
+                MirroredTagging.id.in_(batch))}
+            for id in batch:
+                row = existing.get(id)
+                if row is None:
+                    row = MirroredTagging(id=id, seen_at=now, status="pending")
+                    session.add(row)
+                if id in taggings:
+                    row.tag_id, row.person_id, row.modified_date = taggings[id]
+                if id in done:
+                    row.status = "done"
+                    row.done_at = now
+        for batch in batches(set(target_indexes) | set(fetched_indexes)):
+            existing = {}
+            for person_id, prefix in batch:
+                existing.setdefault(prefix, []).append(person_id)
+            rows = {}
+            for prefix, person_ids in existing.items():
+                for row in PersonTargetIndex.query.filter(
+                        PersonTargetIndex.prefix == prefix,
+                        PersonTargetIndex.person_id.in_(person_ids)):
+                    rows[(row.person_id, row.prefix)] = row
+            for key in batch:
+                row = rows.get(key)
+                if row is None:
+                    row = PersonTargetIndex(person_id=key[0], prefix=key[1], target_index=0)
+                    session.add(row)
+                if key in fetched_indexes:
+                    target_index, fetched_at = fetched_indexes[key]
+                    if row.updated_at is None or row.updated_at <= fetched_at:
+                        row.target_index = target_index
+                        row.updated_at = fetched_at
+                if key in target_indexes and target_indexes[key] >= (row.target_index or 0):
+                    row.target_index = target_indexes[key]
+                    row.updated_at = now
+
+
+def make_mirror(emailer_id):
+    return SqlMirror(emailer_id) if ENABLED else None
@@ -0,0 +1,125 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from resources import Person
+from throttling import hash_key
+
+TTL = int(os.environ.get("PERSON_CACHE_TTL", 900))
+MAX_ENTRIES = int(os.environ.get("PERSON_CACHE_SIZE", 50000))
+BACKEND = os.environ.get("PERSON_CACHE_BACKEND", "redis")
+
+
+class MemoryPersonCache():
+    # Least recently used people are dropped once max_entries is reached
+    def __init__(self, ttl=TTL, max_entries=MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.people = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_many(self, ids):
+        found = {}
+        now = time.monotonic()
+        with self.lock:
+            for id in ids:
+                entry = self.people.get(id)
+                if entry is None:
+                    continue
+                if entry[0] < now:
+                    del self.people[id]
+                    continue
+                self.people.move_to_end(id)
+                found[id] = entry[1]
+        return found
+
+    def set_many(self, people):
+        expires = time.monotonic() + self.ttl
+        with self.lock:
+            for person in people:
+                self.people[person["id"]] = (expires, person)
+                self.people.move_to_end(person["id"])
+            while len(self.people) > self.max_entries:
+                self.people.popitem(last=False)
+
+    def invalidate(self, id):
+        with self.lock:
+            self.people.pop(id, None)
+
+
+class RedisPersonCache():
+    # People are stored as JSON under their own key with a TTL; a sorted set
+    # of last use times lets the least recently used be trimmed
+    def __init__(self, redis, namespace, ttl=TTL, max_entries=MAX_ENTRIES, fields=None):
+        self.redis = redis
+        self.prefix = f"people:{namespace}"
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.fields = fields
+
+    def key(self, id):
+        return f"{self.prefix}:{id}"
+
+    @property
+    def index_key(self):
+        return f"{self.prefix}:used"
+
+    def get_many(self, ids):
+        if not ids:
+            return {}
+        values = self.redis.mget([self.key(id) for id in ids])
+        found = {
+            id: Person.from_json(json.loads(value), self.fields)
+            for id, value in zip(ids, values) if value
+        }
+        if found:
+            self.redis.zadd(self.index_key, {id: time.time() for id in found})
+        return found
+
+    def set_many(self, people):
+        if not people:
+            return
+        now = time.time()
+        pipe = self.redis.pipeline()
+        for person in people:
+            data = person.to_dict() if isinstance(person, Person) else person
+            pipe.set(self.key(person["id"]), json.dumps(data), ex=self.ttl)
+        pipe.zadd(self.index_key, {person["id"]: now for person in people})
+        pipe.expire(self.index_key, self.ttl)
+        pipe.zcard(self.index_key)
+        size = pipe.execute()[-1]
+        if size > self.max_entries:
+            oldest = self.redis.zpopmin(self.index_key, size - self.max_entries)
+            self.redis.delete(*[self.key(id.decode()) for id, _ in oldest])
+
+    def invalidate(self, id):
+        self.redis.delete(self.key(id))
+        self.redis.zrem(self.index_key, id)
+
+
+class NoPersonCache():
+    def get_many(self, ids):
+        return {}
+
+    def set_many(self, people):
+        pass
+
+    def invalidate(self, id):
+        pass
+
+
+memory_caches = {}
+memory_caches_lock = threading.Lock()
+
+
+def get_person_cache(api_key, redis=None, fields=None):
+    # One cache per credential; memory caches live as long as the process
+    if not TTL or not api_key:
+        return NoPersonCache()
+    if BACKEND == "redis" and redis is not None:
+        return RedisPersonCache(redis, hash_key(api_key), fields=fields)
+    with memory_caches_lock:
+        if api_key not in memory_caches:
+            memory_caches[api_key] = MemoryPersonCache()
+        return memory_caches[api_key]
@@ -0,0 +1,58 @@
+import contextvars
+import queue
+import threading
+
+
+class Pipeline():
+    # Stages are (function, workers). Each function takes a job and returns
+    # the job for the next stage, or None to drop it. Queues between stages
+    # are bounded so a slow stage holds back the ones before it.
+    STOP = object()
+
+    def __init__(self, stages, queue_size=10):
+        self.stages = stages
+        self.queue_size = queue_size
+
+    def run(self, jobs, on_error=None):
+        errors = []
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        queues.append(None)
+        stage_threads = []
+        for i, (function, workers) in enumerate(self.stages):
+            # Each worker runs in its own copy of the caller's context
+            threads = [
+                threading.Thread(target=contextvars.copy_context().run, daemon=True,
+                                 args=(self._work, function, queues[i], queues[i + 1], on_error, errors))
+                for _ in range(workers)
+            ]
+            for thread in threads:
+                thread.start()
+            stage_threads.append(threads)
+        try:
+            for job in jobs:
+                queues[0].put(job)
+        finally:
+            # Shut the stages down in order once each has drained
+            for i, threads in enumerate(stage_threads):
+                for _ in threads:
+                    queues[i].put(self.STOP)
+                for thread in threads:
+                    thread.join()
+        if errors:
+            raise errors[0]
+
+    def _work(self, function, in_queue, out_queue, on_error, errors):
+        while True:
+            job = in_queue.get()
+            if job is self.STOP:
+                return
+            try:
+                job = function(job)
+            except Exception as e:
+                if on_error is None:
+                    errors.append(e)
+                else:
+                    on_error(job, e)
+                continue
+            if job is not None and out_queue is not None:
+                out_queue.put(job)
@@ -0,0 +1,67 @@
+import os
+import uuid
+import redis
+
+REDIS_URL = os.environ.get("REDIS_URL", "redis://redis:6379")
+
+_client = None
+
+
+def get_redis():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(REDIS_URL)
+    return _client
+
+
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+EXTEND_SCRIPT = """
+local holder = redis.call('GET', KEYS[1])
+if holder == ARGV[1] or not holder then
+    return redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2]) and 1 or 0
+end
+return 0
+"""
+
+
+def acquire_lock(name, timeout):
+    token = uuid.uuid4().hex
+    if get_redis().set(name, token, nx=True, ex=timeout):
+        return token
+
+
+def release_lock(name, token):
+    # Only release the lock if it is still ours
+    return get_redis().eval(RELEASE_SCRIPT, 1, name, token)
+
+
+def extend_lock(name, token, timeout):
+    # Renews the lock if it is still ours, or takes it back if it has
+    # expired with no one else holding it
+    return get_redis().eval(EXTEND_SCRIPT, 1, name, token, timeout)
+
+
+class RedisSet():
+    def __init__(self, name, ttl=86400):
+        self.name = name
+        self.ttl = ttl
+
+    def __contains__(self, member):
+        return bool(get_redis().sismember(self.name, member))
+
+    def add(self, member):
+        get_redis().sadd(self.name, member)
+        get_redis().expire(self.name, self.ttl)
+
+    def discard(self, member):
+        get_redis().srem(self.name, member)
+
+    def clear(self):
+        get_redis().delete(self.name)
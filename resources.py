@@ -0,0 +1,87 @@
+class Resource():
+    # A compact stand-in for an OSDI item: the plain fields that were asked
+    # for, the hrefs of the links ids come from and, only if requested, the
+    # raw HAL dict. Reads like the dict it replaces.
+    __slots__ = ("fields", "hrefs", "raw")
+    # Link rels kept, and the id key each one provides
+    ID_LINKS = {"self": "id"}
+
+    def __init__(self, fields, hrefs, raw=None):
+        self.fields = fields
+        self.hrefs = hrefs
+        self.raw = raw
+
+    @classmethod
+    def from_json(cls, item, fields=None, keep_raw=False):
+        links = item.get("_links", {})
+        hrefs = tuple(links[rel]["href"] if rel in links else None for rel in cls.ID_LINKS)
+        if fields is None:
+            kept = {key: value for key, value in item.items() if not key.startswith("_")}
+        else:
+            kept = {key: item[key] for key in fields if key in item}
+        return cls(kept, hrefs, item if keep_raw else None)
+
+    def _id_from(self, href):
+        return href.rstrip("/").rsplit("/", 1)[-1] if href else None
+
+    @property
+    def id(self):
+        return self._id_from(self.hrefs[0])
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            return self.fields[key]
+        if key == "_links":
+            return self.links()
+        for id_key, href in zip(self.ID_LINKS.values(), self.hrefs):
+            if id_key == key and href:
+                return self._id_from(href)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def links(self):
+        return {rel: {"href": href} for rel, href in zip(self.ID_LINKS, self.hrefs) if href}
+
+    def to_dict(self):
+        # Plain JSON, as the full items were, for Celery and caches
+        resource = dict(self.raw) if self.raw is not None else dict(self.fields, _links=self.links())
+        for id_key, href in zip(self.ID_LINKS.values(), self.hrefs):
+            if href:
+                resource[id_key] = self._id_from(href)
+        return resource
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.get('id')!r})"
+
+
+class Person(Resource):
+    __slots__ = ()
+
+
+class Tag(Resource):
+    __slots__ = ()
+
+
+class Tagging(Resource):
+    __slots__ = ()
+    ID_LINKS = {"self": "id", "osdi:person": "person_id", "osdi:tag": "tag_id"}
+
+
+RESOURCE_CLASSES = {
+    "osdi:people": Person,
+    "osdi:tags": Tag,
+    "osdi:taggings": Tagging
+}
+
@@ -0,0 +1,62 @@
+import json
+import os
+import time
+
+FRESH_SECONDS = int(os.environ.get("TAGS_CACHE_TTL", 300))
+MAX_AGE_SECONDS = int(os.environ.get("TAGS_CACHE_MAX_AGE", 86400))
+
+
+def cache_key(credential_id):
+    return f"tags:{credential_id}"
+
+
+def fetch_tags(an):
+    return [
+        {
+            "id": tag["id"],
+            "name": tag["name"]
+        } for tag in an.iter_all_parallel("tags", fields=("name",))
+    ]
+
+
+def store_tags(redis, credential_id, tags):
+    redis.set(cache_key(credential_id), json.dumps({
+        "fetched_at": time.time(),
+        "tags": tags
+    }), ex=MAX_AGE_SECONDS)
+
+
+def load_tags(redis, credential_id):
+    # Returns (tags, stale), or (None, True) when nothing is cached
+    cached = redis.get(cache_key(credential_id))
+    if not cached:
+        return None, True
+    cached = json.loads(cached)
+    return cached["tags"], time.time() - cached["fetched_at"] > FRESH_SECONDS
+
+
+def claim_refresh(redis, credential_id):
+    # Only one background refresh per credential at a time
+    return redis.set(refresh_key(credential_id), 1, nx=True, ex=FRESH_SECONDS)
+
+
+def release_refresh(redis, credential_id):
+    redis.delete(refresh_key(credential_id))
+
+
+def refresh_key(credential_id):
+    return f"{cache_key(credential_id)}:refreshing"
+
+
+def invalidate_tags(redis, credential_id):
+    redis.delete(cache_key(credential_id))
+
+
+def search_tags(tags, prefix=None, page=None, per_page=100):
+    if prefix:
+        prefix = prefix.lower()
+        tags = [tag for tag in tags if (tag["name"] or "").lower().startswith(prefix)]
+    total = len(tags)
+    if page:
+        tags = tags[(page - 1) * per_page:page * per_page]
+    return tags, total
@@ -0,0 +1,171 @@
+import heapq
+import json
+import os
+import time
+from redis_client import acquire_lock, release_lock
+
+# Records re-read per formula, keeping the URL well under Airtable's limit
+REREAD_BATCH = 50
+WRITE_LOCK = bool(int(os.environ.get("AIRTABLE_TARGET_WRITE_LOCK", 1)))
+WRITE_LOCK_TIMEOUT = 60
+
+
+def write_increments(airtable, base, table, increments):
+    # increments maps target id -> (emails sent, contacts). Other emailers
+    # update the same targets, so they are re-read under a per-table lock
+    # and this run's counts added to what is there now
+    lock = f"airtable:{base}:{table}:write_lock"
+    token = None
+    while WRITE_LOCK and token is None:
+        token = acquire_lock(lock, WRITE_LOCK_TIMEOUT)
+        if token is None:
+            time.sleep(0.1)
+    try:
+        ids = list(increments)
+        current = {}
+        for i in range(0, len(ids), REREAD_BATCH):
+            formula = "OR(" + ",".join(
+                f"RECORD_ID()='{id}'" for id in ids[i:i + REREAD_BATCH]) + ")"
+            for record in airtable.all(base, table, formula=formula):
+                current[record['id']] = record
+        records = []
+        for id, (sent, contacts) in increments.items():
+            # Deleted since the run loaded it
+            if id not in current:
+                continue
+            fields = current[id]['fields']
+            records.append({"id": id, "fields": {
+                "Emails Sent Manual": int(fields.get('Emails Sent Manual') or 0) + sent,
+                "Contact Sent To": list(fields.get('Contact Sent To') or []) + contacts
+            }})
+        if records:
+            # pyairtable splits these into requests of 10 records
+            airtable.batch_update(base, table, records, typecast=True)
+        return records
+    finally:
+        if token:
+            release_lock(lock, token)
+
+
+class TargetAllocator():
+    # Assumes the target view is sorted by least 'Emails Sent Manual' first, so
+    # ordering on (count, view position) reproduces what the view would return
+    def __init__(self, airtable, base, table, view):
+        self.airtable = airtable
+        self.base = base
+        self.table = table
+        self.view = view
+        self.records = {}
+        self.heap = []
+        # Target record id -> [emails sent, contacts] still to be added in Airtable
+        self.updates = {}
+
+    def load(self):
+        records = self.airtable.all(self.base, self.table, view=self.view)
+        self.records = {record['id']: record for record in records}
+        self.heap = [
+            (self._emails_sent(record), position, record['id'])
+            for position, record in enumerate(records)
+        ]
+        heapq.heapify(self.heap)
+        return self
+
+    def allocate(self, count):
+        taken = [heapq.heappop(self.heap) for _ in range(min(count, len(self.heap)))]
+        for sent, position, id in taken:
+            heapq.heappush(self.heap, (sent + 1, position, id))
+        return [self.records[id] for _, _, id in taken]
+
+    def commit(self, targets, person_href):
+        for target in targets:
+            update = self.updates.setdefault(target['id'], [0, []])
+            update[0] += 1
+            update[1].append(person_href)
+
+    def flush(self):
+        if not self.updates:
+            return
+        written = write_increments(self.airtable, self.base, self.table, self.updates)
+        for record in written:
+            self.records[record['id']]['fields'].update(record['fields'])
+        self.updates = {}
+
+    def _emails_sent(self, target):
+        return int(target['fields'].get('Emails Sent Manual') or 0)
+
+
+class SharedTargetAllocator():
+    # The same least-sent rotation as TargetAllocator, held in Redis so the
+    # subtasks of one run can allocate from it concurrently
+    SCALE = 1000000
+    ALLOCATE_SCRIPT = """
+local taken = redis.call('ZRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+for _, id in ipairs(taken) do
+    redis.call('ZINCRBY', KEYS[1], ARGV[2], id)
+end
+return taken
+"""
+
+    def __init__(self, redis, run_key, airtable, base, table, view, ttl=86400):
+        self.redis = redis
+        self.airtable = airtable
+        self.base = base
+        self.table = table
+        self.view = view
+        self.ttl = ttl
+        self.queue_key = f"{run_key}:targets"
+        self.records_key = f"{run_key}:target_records"
+        self.sent_key = f"{run_key}:target_sent"
+        self.contacts_key = f"{run_key}:target_contacts"
+        self.allocate_script = redis.register_script(self.ALLOCATE_SCRIPT)
+
+    def load(self):
+        records = self.airtable.all(self.base, self.table, view=self.view)
+        pipe = self.redis.pipeline()
+        pipe.delete(self.queue_key, self.records_key, self.sent_key)
+        for position, record in enumerate(records):
+            # Score orders on (count, view position) like the local heap
+            pipe.zadd(self.queue_key, {
+                record['id']: self._emails_sent(record) * self.SCALE + position})
+            pipe.hset(self.records_key, record['id'], json.dumps(record))
+        pipe.expire(self.queue_key, self.ttl)
+        pipe.expire(self.records_key, self.ttl)
+        pipe.execute()
+        return self
+
+    def allocate(self, count):
+        ids = self.allocate_script(keys=[self.queue_key], args=[count, self.SCALE])
+        if len(ids) == 0:
+            return []
+        return [json.loads(record) for record in self.redis.hmget(self.records_key, ids)]
+
+    def commit(self, targets, person_href):
+        pipe = self.redis.pipeline()
+        for target in targets:
+            pipe.hincrby(self.sent_key, target['id'], 1)
+            pipe.rpush(f"{self.contacts_key}:{target['id']}", person_href)
+            pipe.expire(f"{self.contacts_key}:{target['id']}", self.ttl)
+        pipe.expire(self.sent_key, self.ttl)
+        pipe.execute()
+
+    def flush(self):
+        # Counts are written once, by the run's final callback
+        pass
+
+    def write(self):
+        increments = {}
+        for id, sent in self.redis.hgetall(self.sent_key).items():
+            id = id.decode()
+            contacts = [contact.decode() for contact in
+                        self.redis.lrange(f"{self.contacts_key}:{id}", 0, -1)]
+            increments[id] = (int(sent), contacts)
+        if increments:
+            write_increments(self.airtable, self.base, self.table, increments)
+
+    def clear(self):
+        contact_keys = [f"{self.contacts_key}:{id.decode()}"
+                        for id in self.redis.hkeys(self.sent_key)]
+        self.redis.delete(self.queue_key, self.records_key, self.sent_key, *contact_keys)
+
+    def _emails_sent(self, target):
+        return int(target['fields'].get('Emails Sent Manual') or 0)
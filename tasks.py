@@ -1,12 +1,583 @@
-from celery import Celery
+# Loaded before the imports below, which read their settings at import
+from dotenv import load_dotenv
+load_dotenv()
+
+from celery import Celery, chord
+from celery.signals import worker_init, worker_process_shutdown
+from prometheus_client import start_http_server, multiprocess
+import json
+import os
+import uuid
+from datetime import datetime, timezone
+from action_network import ActionNetworkError
 from action_network_rolling_emails import RollingEmailer as RollingEmailerProcess
+from redis_client import REDIS_URL, get_redis, acquire_lock, release_lock, extend_lock, RedisSet
+from clients import get_action_network
+from tags_cache import fetch_tags, store_tags, release_refresh
+from mirror import make_mirror
+from metrics import metrics_registry, clear_multiprocess_dir, RunStats, current_run_stats, current_emailer
 
-celery = Celery("tasks", broker="redis://redis:6379")
+# Chords need a result backend
+celery = Celery("tasks", broker=REDIS_URL, backend=REDIS_URL)
+# Redis redelivers unacked tasks after the visibility timeout, so it has to
+# outlast the longest delay_mins a deferred tagging is scheduled for
+celery.conf.broker_transport_options = {
+    "visibility_timeout": int(os.environ.get("CELERY_VISIBILITY_TIMEOUT", 43200))
+}
 
+@worker_init.connect
+def start_metrics_server(**kwargs):
+    clear_multiprocess_dir()
+    port = os.environ.get("CELERY_METRICS_PORT")
+    if port:
+        start_http_server(int(port), registry=metrics_registry())
 
-@celery.task()
+
+@worker_process_shutdown.connect
+def mark_metrics_process_dead(pid=None, **kwargs):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(pid or os.getpid())
+
+
+DEBOUNCE_SECONDS = int(os.environ.get("EMAILER_DEBOUNCE_SECONDS", 10))
+LOCK_TIMEOUT = int(os.environ.get("EMAILER_LOCK_TIMEOUT", 3600))
+CHUNK_SIZE = int(os.environ.get("EMAILER_CHUNK_SIZE", 25))
+RUN_HISTORY_KEEP = int(os.environ.get("EMAILER_RUN_HISTORY_KEEP", 1000))
+POLL_SECONDS = int(os.environ.get("EMAILER_POLL_SECONDS", 300))
+# How long an emailer in a group remembers taggings it has finished,
+# while the others in its group catch up
+GROUP_DONE_TTL = int(os.environ.get("EMAILER_GROUP_DONE_TTL", 7 * 86400))
+
+if POLL_SECONDS:
+    celery.conf.beat_schedule = {
+        "poll-rolling-emailers": {
+            "task": "tasks.poll_emailers",
+            "schedule": POLL_SECONDS
+        }
+    }
+
+
+def lock_key(emailer_id):
+    return f"emailer:{emailer_id}:lock"
+
+
+def queued_key(emailer_id):
+    return f"emailer:{emailer_id}:queued"
+
+
+def coalesced_key(emailer_id):
+    return f"emailer:{emailer_id}:coalesced"
+
+
+def run_key(emailer_id, run_id):
+    return f"emailer:{emailer_id}:run:{run_id}"
+
+
+def webhook_people_key(emailer_id):
+    return f"emailer:{emailer_id}:webhook_people"
+
+
+def people_queued_key(emailer_id):
+    return f"emailer:{emailer_id}:people_queued"
+
+
+def scheduled_key(emailer_id, tagging_id):
+    return f"emailer:{emailer_id}:scheduled:{tagging_id}"
+
+
+def group_done_key(emailer_id):
+    return f"emailer:{emailer_id}:group_done"
+
+
+def group_queued_key(group):
+    return f"emailer_group:{'-'.join(str(emailer['id']) for emailer in group)}:queued"
+
+
+def group_key(rolling_emailer):
+    # Emailers on one credential watching one tag see the same taggings
+    return (rolling_emailer["action_network_api_key"], rolling_emailer["trigger_tag_id"])
+
+
+def group_emailers(emailers):
+    groups = {}
+    for emailer in emailers:
+        groups.setdefault(group_key(emailer), []).append(emailer)
+    return [sorted(group, key=lambda emailer: emailer["id"]) for group in groups.values()]
+
+
+def schedule_deferred(rolling_emailer, process_tool, taggings):
+    # One scheduled check per tagging, however many runs defer it
+    for tagging in taggings:
+        due_at = process_tool.due_at(tagging)
+        ttl = max(60, int((due_at - datetime.now(timezone.utc)).total_seconds()) + 3600)
+        if get_redis().set(scheduled_key(rolling_emailer["id"], tagging["id"]), 1, nx=True, ex=ttl):
+            process_deferred_tagging.apply_async(
+                (rolling_emailer, tagging["id"]), eta=due_at)
+
+
+def trigger_emailer(rolling_emailer):
+    # At most one run is queued per emailer; triggers while one is queued,
+    # including those arriving during a run, collapse into it
+    emailer_id = rolling_emailer["id"]
+    if get_redis().set(queued_key(emailer_id), 1, nx=True, ex=LOCK_TIMEOUT):
+        process_emailer.apply_async((rolling_emailer,), countdown=DEBOUNCE_SECONDS)
+        return True
+    get_redis().incr(coalesced_key(emailer_id))
+    return False
+
+
+def trigger_group(group):
+    # Emailers sharing their taggings with others run together, so the
+    # taggings and people are fetched once and deleted when all are done
+    if len(group) == 1:
+        return trigger_emailer(group[0])
+    if get_redis().set(group_queued_key(group), 1, nx=True, ex=LOCK_TIMEOUT):
+        process_emailer_group.apply_async((group,), countdown=DEBOUNCE_SECONDS)
+        return True
+    for emailer in group:
+        get_redis().incr(coalesced_key(emailer["id"]))
+    return False
+
+
+def queue_people(rolling_emailer, people):
+    # Webhook people collect per emailer, keyed by id, and one run at a time
+    # is queued to take them all, as trigger_emailer does for polls
+    emailer_id = rolling_emailer["id"]
+    add_webhook_people(emailer_id, people)
+    if get_redis().set(people_queued_key(emailer_id), 1, nx=True, ex=LOCK_TIMEOUT):
+        process_people.apply_async((rolling_emailer,), countdown=DEBOUNCE_SECONDS)
+        return True
+    get_redis().incr(coalesced_key(emailer_id))
+    return False
+
+
+def add_webhook_people(emailer_id, people, replace=True):
+    key = webhook_people_key(emailer_id)
+    pipe = get_redis().pipeline()
+    for person in people:
+        if replace:
+            pipe.hset(key, person["id"], json.dumps(person))
+        else:
+            # Putting back a failed run's people mustn't undo newer webhooks
+            pipe.hsetnx(key, person["id"], json.dumps(person))
+    pipe.expire(key, LOCK_TIMEOUT)
+    pipe.execute()
+
+
+def take_webhook_people(emailer_id):
+    key = webhook_people_key(emailer_id)
+    pipe = get_redis().pipeline()
+    pipe.hgetall(key)
+    pipe.delete(key)
+    people = pipe.execute()[0]
+    return [json.loads(person) for person in people.values()]
+
+
+def coalesced_triggers(emailer_id):
+    return int(get_redis().get(coalesced_key(emailer_id)) or 0)
+
+
+# Processed taggings are deleted as they go, so a retried run picks up the rest
+@celery.task(autoretry_for=(ActionNetworkError,), retry_backoff=30, retry_jitter=True, max_retries=3)
 def process_emailer(rolling_emailer):
-    print("Process Emailer Starting")
+    emailer_id = rolling_emailer["id"]
+    token = acquire_lock(lock_key(emailer_id), LOCK_TIMEOUT)
+    if not token:
+        # A run is in progress; this becomes the one follow-up run
+        process_emailer.apply_async((rolling_emailer,), countdown=DEBOUNCE_SECONDS)
+        return None
+    get_redis().delete(queued_key(emailer_id))
+    handed_off = False
+    stats = RunStats()
+    current_run_stats.set(stats)
+    log_id = None
+    try:
+        log_id = start_run(emailer_id, "poll")
+        print("Process Emailer Starting")
+        # Reload so a follow-up run sees the watermark the last run saved
+        rolling_emailer = load_emailer(emailer_id) or rolling_emailer
+        process_tool = make_process_tool(rolling_emailer)
+        try:
+            taggings = process_tool.new_taggings()
+        finally:
+            process_tool.close()
+        process_tool.advance_watermark(taggings)
+        process_tool.mirror_taggings(taggings)
+        process_tool.flush_mirror()
+        process_tool.log(f"Processing {len(taggings)} new taggings.")
+        run_fields = {
+            "taggings_seen": len(taggings),
+            "oldest_tagging_age": process_tool.oldest_tagging_age(taggings)
+        }
+        if len(taggings) == 0:
+            update_emailer(emailer_id, tagging_watermark=process_tool.watermark,
+                           pending_taggings=json.dumps([]))
+            update_run(log_id, stats.to_dict(), status="complete",
+                       finished_at=datetime.utcnow(), **run_fields)
+            return 0
+        run_id = uuid.uuid4().hex
+        process_tool.shared_target_allocator(run_key(emailer_id, run_id)).load()
+        update_run(log_id, stats.to_dict(), **run_fields)
+        # Compact taggings go to the chunk tasks as plain JSON
+        taggings = [tagging.to_dict() for tagging in taggings]
+        chunks = [taggings[i:i + CHUNK_SIZE] for i in range(0, len(taggings), CHUNK_SIZE)]
+        # The lock passes to the callback, which releases it when the run ends
+        callback = finish_emailer_run.s(
+            rolling_emailer, run_id, token, process_tool.watermark, log_id
+        ).on_error(abort_emailer_run.s(rolling_emailer, run_id, token, log_id))
+        chord(process_taggings_chunk.s(rolling_emailer, run_id, chunk, token=token)
+              for chunk in chunks)(callback)
+        handed_off = True
+        return len(taggings)
+    except Exception as e:
+        update_run(log_id, stats.to_dict(), status="failed",
+                   finished_at=datetime.utcnow(), errors=[repr(e)])
+        raise
+    finally:
+        if not handed_off:
+            release_lock(lock_key(emailer_id), token)
+
+
+@celery.task(bind=True, max_retries=3)
+def process_taggings_chunk(self, rolling_emailer, run_id, taggings, processed=0, deferred=None, stats=None,
+                           token=None):
+    key = run_key(rolling_emailer["id"], run_id)
+    if token and not extend_lock(lock_key(rolling_emailer["id"]), token, LOCK_TIMEOUT):
+        # Another run holds the emailer, and may have listed these taggings
+        # too; they stay in place for the next poll rather than go out twice
+        return {
+            "processed": processed,
+            "deferred": (deferred or []) + [tagging["id"] for tagging in taggings],
+            "errors": ["Lost the emailer lock"],
+            "stats": stats
+        }
+    stats = RunStats(stats)
+    current_run_stats.set(stats)
+    process_tool = make_process_tool(rolling_emailer)
+    process_tool.target_allocator = process_tool.shared_target_allocator(key)
+    failed = []
+    errors = []
+
+    def on_error(tagging, e):
+        failed.append(tagging)
+        errors.append(f"{tagging['id']}: {e!r}")
+
+    try:
+        result = process_tool.process_chunk(
+            taggings,
+            done=RedisSet(f"{key}:done"),
+            on_error=on_error
+        )
+    except Exception as e:
+        if self.request.retries >= self.max_retries:
+            raise
+        # The done set keeps a retried chunk from emailing anyone twice
+        raise self.retry(args=(rolling_emailer, run_id, taggings, processed, deferred, stats.to_dict()),
+                         kwargs={"token": token}, exc=e, countdown=30 * 2 ** self.request.retries)
+    finally:
+        process_tool.close()
+        # The shared allocator is written by finish_emailer_run; this
+        # writes the mirror rows
+        process_tool.flush_target_updates()
+    processed += result["processed"]
+    deferred = (deferred or []) + result["deferred"]
+    schedule_deferred(rolling_emailer, process_tool, [
+        tagging for tagging in taggings if tagging["id"] in result["deferred"]])
+    if failed and self.request.retries < self.max_retries:
+        # Retry only the people that failed, carrying the counts so far
+        raise self.retry(args=(rolling_emailer, run_id, failed, processed, deferred, stats.to_dict()),
+                         kwargs={"token": token}, countdown=30 * 2 ** self.request.retries)
+    # Taggings that still fail stay in place for the next poll
+    return {
+        "processed": processed,
+        "deferred": deferred + [tagging["id"] for tagging in failed],
+        "errors": errors,
+        "stats": stats.to_dict()
+    }
+
+
+@celery.task()
+def finish_emailer_run(results, rolling_emailer, run_id, token, watermark, log_id=None):
+    emailer_id = rolling_emailer["id"]
+    key = run_key(emailer_id, run_id)
+    stats = RunStats()
+    current_run_stats.set(stats)
+    process_tool = make_process_tool(rolling_emailer)
+    allocator = process_tool.shared_target_allocator(key)
+    try:
+        allocator.write()
+        processed = sum(result["processed"] for result in results)
+        deferred = [id for result in results for id in result["deferred"]]
+        update_emailer(emailer_id, tagging_watermark=watermark,
+                       pending_taggings=json.dumps(deferred))
+        process_tool.log(f"Processing complete for {processed} taggings.")
+        update_run(log_id, stats.to_dict(), *[result.get("stats") for result in results],
+                   errors=[error for result in results for error in result.get("errors", [])],
+                   status="complete", finished_at=datetime.utcnow(),
+                   processed=processed, deferred=len(deferred))
+        return processed
+    finally:
+        allocator.clear()
+        RedisSet(f"{key}:done").clear()
+        release_lock(lock_key(emailer_id), token)
+
+
+@celery.task()
+def abort_emailer_run(request, exc, traceback, rolling_emailer, run_id, token, log_id=None):
+    # Count the emails that did go out; the watermark stays put so the
+    # next poll sees every tagging that is left
+    emailer_id = rolling_emailer["id"]
+    key = run_key(emailer_id, run_id)
+    allocator = make_process_tool(rolling_emailer).shared_target_allocator(key)
+    try:
+        allocator.write()
+    finally:
+        allocator.clear()
+        RedisSet(f"{key}:done").clear()
+        release_lock(lock_key(emailer_id), token)
+        update_run(log_id, status="failed", finished_at=datetime.utcnow(), errors=[repr(exc)])
+
+
+@celery.task(autoretry_for=(ActionNetworkError,), retry_backoff=30, retry_jitter=True, max_retries=3)
+def process_people(rolling_emailer, people=None):
+    emailer_id = rolling_emailer["id"]
+    if people:
+        # Queued before webhook people were collected in Redis
+        add_webhook_people(emailer_id, people)
+    token = acquire_lock(lock_key(emailer_id), LOCK_TIMEOUT)
+    if not token:
+        # A run is in progress; people arriving meanwhile wait for this one
+        process_people.apply_async((rolling_emailer,), countdown=DEBOUNCE_SECONDS)
+        return None
+    get_redis().delete(people_queued_key(emailer_id))
+    people = take_webhook_people(emailer_id)
+    if len(people) == 0:
+        release_lock(lock_key(emailer_id), token)
+        return 0
+    stats = RunStats()
+    current_run_stats.set(stats)
+    log_id = None
+    try:
+        log_id = start_run(emailer_id, "webhook", taggings_seen=len(people))
+        print(f"Process People Starting for {len(people)} people")
+        process_tool = make_process_tool(rolling_emailer)
+        processed = process_tool.process_people(people)
+        schedule_deferred(rolling_emailer, process_tool, process_tool.deferred_taggings)
+        update_run(log_id, stats.to_dict(), status="complete", finished_at=datetime.utcnow(),
+                   processed=processed, deferred=len(process_tool.deferred_taggings))
+        return processed
+    except Exception as e:
+        # Left for the retry; people already emailed have no trigger tagging
+        add_webhook_people(emailer_id, people, replace=False)
+        update_run(log_id, stats.to_dict(), status="failed",
+                   finished_at=datetime.utcnow(), errors=[repr(e)])
+        raise
+    finally:
+        release_lock(lock_key(emailer_id), token)
+
+
+@celery.task(autoretry_for=(ActionNetworkError,), retry_backoff=30, retry_jitter=True, max_retries=3)
+def process_deferred_tagging(rolling_emailer, tagging_id):
+    emailer_id = rolling_emailer["id"]
+    token = acquire_lock(lock_key(emailer_id), LOCK_TIMEOUT)
+    if not token:
+        process_deferred_tagging.apply_async(
+            (rolling_emailer, tagging_id), countdown=DEBOUNCE_SECONDS)
+        return None
+    try:
+        get_redis().delete(scheduled_key(emailer_id, tagging_id))
+        process_tool = make_process_tool(rolling_emailer)
+        tagging = process_tool.an.get(
+            f"tags/{rolling_emailer['trigger_tag_id']}/taggings", tagging_id,
+            fields=process_tool.TAGGING_FIELDS)
+        if tagging is None:
+            # Already handled by a poll or webhook
+            if process_tool.mirror:
+                process_tool.mirror.tagging_done(tagging_id)
+                process_tool.flush_mirror()
+            return 0
+        stats = RunStats()
+        current_run_stats.set(stats)
+        log_id = start_run(emailer_id, "deferred", taggings_seen=1,
+                           oldest_tagging_age=process_tool.oldest_tagging_age([tagging]))
+        try:
+            result = process_tool.process_chunk([tagging])
+        except Exception as e:
+            update_run(log_id, stats.to_dict(), status="failed",
+                       finished_at=datetime.utcnow(), errors=[repr(e)])
+            raise
+        finally:
+            process_tool.close()
+            process_tool.flush_target_updates()
+        schedule_deferred(rolling_emailer, process_tool,
+                          [tagging] if result["deferred"] else [])
+        update_run(log_id, stats.to_dict(), status="complete", finished_at=datetime.utcnow(),
+                   processed=result["processed"], deferred=len(result["deferred"]))
+        return result["processed"]
+    finally:
+        release_lock(lock_key(emailer_id), token)
+
+
+@celery.task()
+def poll_emailers():
+    groups = group_emailers(load_emailers())
+    for group in groups:
+        trigger_group(group)
+    return len(groups)
+
+
+@celery.task(autoretry_for=(ActionNetworkError,), retry_backoff=30, retry_jitter=True, max_retries=3)
+def process_emailer_group(group):
+    tokens = acquire_group_locks(group)
+    if tokens is None:
+        # One of the emailers is running; try the group again shortly
+        process_emailer_group.apply_async((group,), countdown=DEBOUNCE_SECONDS)
+        return None
+    get_redis().delete(group_queued_key(group))
+    shared_stats = RunStats()
+    current_run_stats.set(shared_stats)
+    members = []
+    fetcher = None
+    try:
+        print(f"Process Emailer Group Starting for {len(group)} emailers")
+        # Reload so the run sees the watermarks the last run saved
+        group = [load_emailer(emailer["id"]) or emailer for emailer in group]
+        watermarks = [emailer.get("tagging_watermark") for emailer in group]
+        pending = set(id for emailer in group for id in emailer.get("pending_taggings") or [])
+        # From the earliest watermark, with every emailer's pending taggings
+        fetcher = make_process_tool(dict(
+            group[0],
+            tagging_watermark=min(watermarks) if all(watermarks) else None,
+            pending_taggings=list(pending)
+        ))
+        fetcher.mirror_prefixes = [emailer["prefix"] for emailer in group]
+        taggings = fetcher.new_taggings()
+        fetcher.advance_watermark(taggings)
+        fetcher.mirror_taggings(taggings)
+        fetcher.flush_mirror()
+        # Emailers on the same target view allocate from one rotation, so
+        # they spread their emails across its targets between them
+        allocators = {}
+        for emailer in group:
+            member = {
+                "emailer": emailer,
+                "tool": make_process_tool(emailer),
+                "done": RedisSet(group_done_key(emailer["id"]), GROUP_DONE_TTL),
+                "stats": RunStats(),
+                "processed": 0,
+                "errors": [],
+                "log_id": start_run(emailer["id"], "group", taggings_seen=len(taggings),
+                                    oldest_tagging_age=fetcher.oldest_tagging_age(taggings))
+            }
+            current_run_stats.set(member["stats"])
+            member["tool"].messages = member["tool"]._load_messages()
+            if emailer["target_view"] not in allocators:
+                allocators[emailer["target_view"]] = member["tool"]._load_target_allocator()
+            member["tool"].target_allocator = allocators[emailer["target_view"]]
+            members.append(member)
+        fetched = []
+        # Finished by every emailer and deleted, so no longer in any done set
+        deleted = set()
+        try:
+            for i in range(0, len(taggings), CHUNK_SIZE):
+                if not extend_group_locks(group, tokens):
+                    # Left waiting for the next poll, as another run may
+                    # have listed them too
+                    fetched.extend(taggings[i:])
+                    for member in members:
+                        member["errors"].append("Lost the emailer lock")
+                    break
+                current_run_stats.set(shared_stats)
+                current_emailer.set(fetcher.prefix)
+                batch = taggings[i:i + CHUNK_SIZE]
+                jobs = list(fetcher._fetch_jobs(batch))
+                fetched.extend(job["tagging"] for job in jobs)
+                for member in members:
+                    process_group_jobs(member, jobs)
+                current_run_stats.set(shared_stats)
+                for job in jobs:
+                    tagging = job["tagging"]
+                    if all(tagging["id"] in member["done"] for member in members):
+                        fetcher.delete_taggings([tagging])
+                        deleted.add(tagging["id"])
+                        for member in members:
+                            member["done"].discard(tagging["id"])
+        finally:
+            fetcher.flush_mirror()
+            for member in members:
+                current_run_stats.set(member["stats"])
+                member["tool"].flush_target_updates()
+        # Deferred taggings wait for the next poll; a scheduled check would
+        # delete them for one emailer only
+        for member in members:
+            emailer_id = member["emailer"]["id"]
+            waiting = [tagging["id"] for tagging in fetched
+                       if tagging["id"] not in deleted and tagging["id"] not in member["done"]]
+            update_emailer(emailer_id, tagging_watermark=fetcher.watermark,
+                           pending_taggings=json.dumps(waiting))
+            # The shared fetches are counted on the first emailer's run
+            update_run(member["log_id"], member["stats"].to_dict(),
+                       shared_stats.to_dict() if member is members[0] else None,
+                       errors=member["errors"], status="complete", finished_at=datetime.utcnow(),
+                       processed=member["processed"], deferred=len(waiting))
+            member["tool"].log(f"Group processing complete for {member['processed']} taggings.")
+        return len(taggings)
+    except Exception as e:
+        for member in members:
+            update_run(member["log_id"], member["stats"].to_dict(), status="failed",
+                       finished_at=datetime.utcnow(), errors=[repr(e)])
+        raise
+    finally:
+        if fetcher:
+            fetcher.close()
+        release_group_locks(group, tokens)
+
+
+def process_group_jobs(member, jobs):
+    tool = member["tool"]
+    current_run_stats.set(member["stats"])
+    current_emailer.set(tool.prefix)
+    # Each emailer gets its own job dicts, as assignment is added to them
+    result = tool.process_jobs(
+        ({"tagging": job["tagging"], "person": job["person"]} for job in jobs),
+        done=member["done"],
+        on_error=lambda tagging, e: member["errors"].append(f"{tagging['id']}: {e!r}"),
+        delete_taggings=False
+    )
+    member["processed"] += result["processed"]
+
+
+def acquire_group_locks(group):
+    tokens = []
+    for emailer in group:
+        token = acquire_lock(lock_key(emailer["id"]), LOCK_TIMEOUT)
+        if not token:
+            release_group_locks(group, tokens)
+            return None
+        tokens.append(token)
+    return tokens
+
+
+def extend_group_locks(group, tokens):
+    return all([extend_lock(lock_key(emailer["id"]), token, LOCK_TIMEOUT)
+                for emailer, token in zip(group, tokens)])
+
+
+def release_group_locks(group, tokens):
+    for emailer, token in zip(group, tokens):
+        release_lock(lock_key(emailer["id"]), token)
+
+
+@celery.task(autoretry_for=(ActionNetworkError,), retry_backoff=30, retry_jitter=True, max_retries=3)
+def refresh_tags_cache(credential_id, key_name, rate_limit=None):
+    try:
+        an = get_action_network(os.environ.get(key_name), rate_limit)
+        store_tags(get_redis(), credential_id, fetch_tags(an))
+    finally:
+        release_refresh(get_redis(), credential_id)
+
+
+def make_process_tool(rolling_emailer):
     process_tool = RollingEmailerProcess(
         rolling_emailer["trigger_tag_id"],
         rolling_emailer["target_view"],
@@ -15,8 +586,72 @@ def process_emailer(rolling_emailer):
         rolling_emailer["end_tag_id"],
         an_key=rolling_emailer["action_network_api_key"],
         targets_each=rolling_emailer["targets_each"],
-        delay_mins=rolling_emailer["delay_mins"]
+        delay_mins=rolling_emailer["delay_mins"],
+        rate_limit=rolling_emailer.get("rate_limit"),
+        watermark=rolling_emailer.get("tagging_watermark"),
+        pending_tagging_ids=rolling_emailer.get("pending_taggings")
     )
-    return process_tool.process()
+    process_tool.mirror = make_mirror(rolling_emailer["id"])
+    return process_tool
+
+
+def load_emailer(emailer_id):
+    # Imported here as app imports this module
+    from app import app, RollingEmailer
+    with app.app_context():
+        emailer = RollingEmailer.query.get(emailer_id)
+        return emailer.to_dict() if emailer else None
+
+
+def load_emailers():
+    # Imported here as app imports this module
+    from app import app, RollingEmailer
+    with app.app_context():
+        return [emailer.to_dict() for emailer in RollingEmailer.query.order_by(RollingEmailer.id)]
+
+
+def update_emailer(emailer_id, **fields):
+    # Imported here as app imports this module
+    from app import app, db, RollingEmailer
+    with app.app_context():
+        emailer = RollingEmailer.query.get(emailer_id)
+        if emailer:
+            for attr in fields:
+                setattr(emailer, attr, fields[attr])
+            db.session.commit()
+
+
+def start_run(emailer_id, kind, **fields):
+    # Imported here as app imports this module
+    from app import app, db, RollingEmailerRun
+    with app.app_context():
+        run = RollingEmailerRun(rolling_emailer_id=emailer_id, kind=kind,
+                                started_at=datetime.utcnow(), **fields)
+        db.session.add(run)
+        db.session.commit()
+        # Only the latest runs are kept for each emailer
+        stale = RollingEmailerRun.query.filter_by(rolling_emailer_id=emailer_id).order_by(
+            RollingEmailerRun.started_at.desc()).offset(RUN_HISTORY_KEEP).all()
+        for old_run in stale:
+            db.session.delete(old_run)
+        db.session.commit()
+        return run.id
+
+
+def update_run(run_id, *stats, errors=None, **fields):
+    if run_id is None:
+        return
+    # Imported here as app imports this module
+    from app import app, db, RollingEmailerRun
+    with app.app_context():
+        run = RollingEmailerRun.query.get(run_id)
+        if run:
+            for task_stats in stats:
+                if task_stats:
+                    run.add_stats(task_stats)
+            run.add_errors(errors)
+            for attr in fields:
+                setattr(run, attr, fields[attr])
+            db.session.commit()
 
 # celery.autodiscover_tasks()
@@ -0,0 +1,171 @@
+import asyncio
+import hashlib
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+
+class ActionNetworkError(Exception):
+    # Defined here rather than in action_network so the throttling errors
+    # below can be retried like any other API failure
+    def __init__(self, message, response=None):
+        super().__init__(message)
+        self.response = response
+
+
+class RateLimitTimeout(ActionNetworkError):
+    pass
+
+
+class TokenBucket():
+    # Refill and take one token atomically, using the Redis clock so every
+    # worker agrees on the time. Returns how long to wait if the bucket is empty.
+    SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+    def __init__(self, redis, api_key, rate=4, burst=None, max_wait=60):
+        self.redis = redis
+        self.key = f"an:ratelimit:{hash_key(api_key)}"
+        self.rate = float(rate)
+        self.burst = float(burst) if burst else max(self.rate, 1)
+        self.max_wait = max_wait
+        self.script = redis.register_script(self.SCRIPT)
+
+    def reserve(self):
+        return float(self.script(keys=[self.key], args=[self.rate, self.burst]))
+
+    def acquire(self):
+        waited = 0
+        while True:
+            wait = self.reserve()
+            if wait <= 0:
+                return waited
+            if waited + wait > self.max_wait:
+                raise RateLimitTimeout(
+                    f"Waited {waited:.1f}s for an Action Network rate limit slot")
+            time.sleep(wait)
+            waited += wait
+
+
+def hash_key(api_key):
+    # Keep raw API keys out of Redis key names
+    return hashlib.sha1(api_key.encode()).hexdigest()[:16]
+
+
+class CircuitOpen(ActionNetworkError):
+    pass
+
+
+class CircuitBreaker():
+    def __init__(self, redis, api_key, threshold=5, cooldown=30, max_wait=300):
+        self.redis = redis
+        self.failures_key = f"an:circuit:{hash_key(api_key)}:failures"
+        self.open_key = f"an:circuit:{hash_key(api_key)}:open"
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_wait = max_wait
+
+    def wait(self):
+        # Pause, rather than fail, while another worker has tripped the breaker
+        waited = 0
+        while True:
+            ttl = self.redis.pttl(self.open_key)
+            if ttl <= 0:
+                return waited
+            if waited + ttl / 1000 > self.max_wait:
+                raise CircuitOpen("Action Network circuit breaker is open")
+            time.sleep(ttl / 1000)
+            waited += ttl / 1000
+
+    def record_success(self):
+        self.redis.delete(self.failures_key)
+
+    def record_failure(self):
+        failures = self.redis.incr(self.failures_key)
+        self.redis.expire(self.failures_key, self.cooldown * 2)
+        if failures >= self.threshold:
+            self.redis.set(self.open_key, 1, px=int(self.cooldown * 1000))
+            self.redis.delete(self.failures_key)
+
+
+class AdaptiveConcurrency():
+    # Additive increase, multiplicative decrease on the number of requests
+    # a client lets through at once
+    def __init__(self, initial=4, minimum=1, maximum=10, latency_target=2.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def try_acquire(self):
+        with self.condition:
+            if self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            return True
+
+    async def acquire_async(self):
+        # Polls, so one limiter can be shared by threads and event loops
+        # without blocking either
+        delay = 0.005
+        while not self.try_acquire():
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+
+    def release(self, latency, ok):
+        with self.condition:
+            self.in_flight -= 1
+            if ok and latency <= self.latency_target:
+                # Roughly +1 per limit's worth of successful requests
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            else:
+                self.limit = max(self.minimum, self.limit / 2)
+            self.condition.notify_all()
+
+
+def backoff_delay(attempt, retry_after=None, base=0.5, cap=60):
+    if retry_after is not None:
+        return min(cap, retry_after)
+    # Full jitter
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0, (retry_at - datetime.now(timezone.utc)).total_seconds())
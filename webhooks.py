@@ -0,0 +1,34 @@
+class WebhookPayloadError(ValueError):
+    pass
+
+
+def people_from_webhook(payload):
+    # Action Network posts a list of events, each keyed by its resource type,
+    # e.g. [{"osdi:submission": {"person": {...}, "_links": {"osdi:person": ...}}}]
+    if not isinstance(payload, list):
+        raise WebhookPayloadError("Expected a list of events")
+    people = {}
+    for event in payload:
+        if not isinstance(event, dict):
+            raise WebhookPayloadError("Expected each event to be an object")
+        for key in event:
+            resource = event[key]
+            if not isinstance(resource, dict):
+                continue
+            links = resource.get("_links", {})
+            if not isinstance(links, dict):
+                raise WebhookPayloadError("Expected _links to be an object")
+            person_link = links.get("osdi:person")
+            if person_link is not None and not isinstance(person_link, dict):
+                raise WebhookPayloadError("Expected osdi:person to be an object")
+            if not person_link or not person_link.get("href"):
+                continue
+            href = person_link["href"]
+            person_id = href.rstrip("/").split("/")[-1]
+            # Only the id is trusted; the embedded person can be stale or
+            # partial, so the emailer resolves the current record itself
+            people[person_id] = {
+                "id": person_id,
+                "_links": {"self": {"href": href}}
+            }
+    return list(people.values())